@@ -0,0 +1,160 @@
+import argparse
+import base64
+import hashlib
+import json
+import os
+import time
+import zipfile
+from collections import namedtuple
+
+from log_utils import logger
+
+try:
+    # FastCDC的C扩展实现，分块点与IDE中的FastCDC(同一GEAR表)一致
+    from fastcdc import fastcdc
+except ImportError:
+    fastcdc = None
+
+BLOCKMAP_SUFFIX = '.blockmap.zip'
+HASH_SUFFIX = '.hash.json'
+BLOCKMAP_ENTRY = 'blockmap.json'
+ALGORITHM = 'SHA-256'
+# 与IDE计算本地旧版本分块时使用的参数一致，参数不同时分块无法对齐
+MIN_SIZE = 2 * 1024
+NORMAL_SIZE = 8 * 1024
+MAX_SIZE = 64 * 1024
+READ_SIZE = 1024 * 1024
+
+Chunk = namedtuple('Chunk', ['hash', 'offset', 'length'])
+Sidecars = namedtuple('Sidecars', ['blockmap_path', 'hash_path', 'chunks', 'size', 'elapsed'])
+
+
+def is_available():
+    return fastcdc is not None
+
+
+def chunk_file(file_path: str):
+    """
+    按内容分块并计算每块的SHA-256
+    :return: [Chunk, ...]，hash为base64编码
+    """
+    if fastcdc is None:
+        raise RuntimeError('fastcdc is not installed')
+    if os.path.getsize(file_path) == 0:
+        return []
+    return [Chunk(base64.b64encode(bytes.fromhex(chunk.hash)).decode('ascii'), chunk.offset, chunk.length)
+            for chunk in fastcdc(file_path, MIN_SIZE, NORMAL_SIZE, MAX_SIZE, hf=hashlib.sha256)]
+
+
+def file_hash(file_path: str):
+    """
+    :return: 整个文件SHA-256的base64编码
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            sha256.update(data)
+    return base64.b64encode(sha256.digest()).decode('ascii')
+
+
+def read_blockmap(blockmap_path: str):
+    """
+    :return: [Chunk, ...]
+    """
+    with zipfile.ZipFile(blockmap_path) as archive:
+        blockmap = json.loads(archive.read(BLOCKMAP_ENTRY))
+    return [Chunk(chunk['hash'], chunk['offset'], chunk['length']) for chunk in blockmap['chunks']]
+
+
+def _write_atomic(path, write):
+    tmp_path = ''.join([path, '.tmp'])
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_sidecars(archive_path: str):
+    """
+    生成插件包的差量更新附加文件，与从JetBrains镜像的格式相同，保存在插件包旁边：
+    <插件包>.blockmap.zip中的blockmap.json记录各块的偏移、长度和摘要，IDE据此只下载本地旧版本中没有的块；
+    <插件包>.hash.json记录整个文件的摘要，用于校验拼接后的文件
+    :return: Sidecars
+    """
+    start = time.perf_counter()
+    chunks = chunk_file(archive_path)
+    blockmap = {
+        'chunks': [chunk._asdict() for chunk in chunks],
+        'algorithm': ALGORITHM,
+        'minSize': MIN_SIZE,
+        'normalSize': NORMAL_SIZE,
+        'maxSize': MAX_SIZE,
+    }
+
+    def write_blockmap(path):
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr(BLOCKMAP_ENTRY, json.dumps(blockmap, separators=(',', ':')))
+
+    def write_hash(path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'algorithm': ALGORITHM, 'hash': file_hash(archive_path)}, f)
+
+    blockmap_path = ''.join([archive_path, BLOCKMAP_SUFFIX])
+    hash_path = ''.join([archive_path, HASH_SUFFIX])
+    _write_atomic(blockmap_path, write_blockmap)
+    _write_atomic(hash_path, write_hash)
+    return Sidecars(blockmap_path, hash_path, chunks, os.path.getsize(archive_path), time.perf_counter() - start)
+
+
+def compare(old_chunks: list, new_chunks: list):
+    """
+    计算从旧版本差量更新到新版本需要下载的数据量
+    :return: {'size': 新版本大小, 'download': 需要下载的字节数, 'reused': 可复用的字节数, 'saved_ratio': 节省比例}
+    """
+    old_hashes = {chunk.hash for chunk in old_chunks}
+    size = sum(chunk.length for chunk in new_chunks)
+    download = sum(chunk.length for chunk in new_chunks if chunk.hash not in old_hashes)
+    return {'size': size, 'download': download, 'reused': size - download,
+            'saved_ratio': round((size - download) / size, 4) if size else 0}
+
+
+def benchmark(file_paths: list, rounds: int = 3):
+    """
+    统计生成附加文件的耗时，并计算相邻两个文件(同一插件按版本排列)之间差量更新节省的流量
+    """
+    previous_chunks = None
+    for file_path in file_paths:
+        elapsed = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            chunks = chunk_file(file_path)
+            file_hash(file_path)
+            elapsed.append(time.perf_counter() - start)
+        size = os.path.getsize(file_path)
+        best = min(elapsed)
+        logger.info('{}: {} bytes, {} chunks, best of {} {:.0f} ms, {:.1f} MB/s'.format(
+            file_path, size, len(chunks), rounds, best * 1000, size / 1024 / 1024 / best if best > 0 else 0))
+        if previous_chunks is not None:
+            logger.info('differential update: {}'.format(compare(previous_chunks, chunks)))
+        previous_chunks = chunks
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='generate blockmap sidecars or benchmark them')
+    parser.add_argument('command', choices=['generate', 'benchmark'])
+    parser.add_argument('files', nargs='+', help='plugin archives, consecutive versions of one plugin in order')
+    parser.add_argument('--rounds', type=int, default=3, help='benchmark: rounds per file')
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        for archive_file in args.files:
+            sidecars = write_sidecars(archive_file)
+            logger.info('{}: {} chunks in {:.0f} ms'.format(sidecars.blockmap_path, len(sidecars.chunks),
+                                                            sidecars.elapsed * 1000))
+    else:
+        benchmark(args.files, args.rounds)
@@ -0,0 +1,65 @@
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+
+CatalogDocument = namedtuple('CatalogDocument', ['etag', 'gzip_body', 'size'])
+
+
+class CatalogCache:
+    """
+    updatePlugins.xml的内存LRU缓存，缓存gzip压缩后的文档
+    缓存键为(product_code, build_version, generation)，generation变化后旧文档不再命中，由LRU自然淘汰
+    """
+
+    def __init__(self, max_entries=256, compress_level=6):
+        self.max_entries = max_entries
+        self.compress_level = compress_level
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, product_code, build_version, generation, loader):
+        """
+        获取缓存的文档，未命中时调用loader生成
+        :param product_code: 产品代码
+        :param build_version: IDE构建版本
+        :param generation: 目录版本标识
+        :param loader: 生成xml字节串的无参函数
+        :return: CatalogDocument
+        """
+        key = (product_code, build_version, generation)
+        with self._lock:
+            document = self._entries.get(key)
+            if document is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return document
+            self.misses += 1
+
+        content = loader()
+        # mtime固定为0，保证相同内容压缩结果一致，ETag可以作为强校验使用
+        document = CatalogDocument(etag=hashlib.sha256(content).hexdigest(),
+                                   gzip_body=gzip.compress(content, compresslevel=self.compress_level, mtime=0),
+                                   size=len(content))
+        with self._lock:
+            self._entries[key] = document
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return document
+
+    def invalidate(self, product_code, build_version):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == product_code and k[1] == build_version]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'max_entries': self.max_entries,
+                    'hits': self.hits, 'misses': self.misses}
@@ -1,7 +1,14 @@
 import hashlib
+import os
 import re
 import string
 import random
+import sys
+
+try:
+    import resource
+except ImportError:  # Windows下没有resource模块
+    resource = None
 
 
 def get_file_md5sum(file):
@@ -16,6 +23,107 @@ def get_file_md5sum(file):
     return m.hexdigest()
 
 
+def save_stream_with_md5(stream, file_path, buffer_size=64 * 1024):
+    """
+    将输入流写入文件并同时计算md5，数据只经过一次
+    :param stream: 可读的二进制流
+    :param file_path: 目标文件
+    :param buffer_size: 每次读取的字节数
+    :return: (写入的字节数, md5)
+    """
+    m = hashlib.md5()
+    size = 0
+    with open(file_path, 'wb') as f:
+        while True:
+            data = stream.read(buffer_size)
+            if not data:
+                break
+
+            m.update(data)
+            f.write(data)
+            size += len(data)
+    return size, m.hexdigest()
+
+
+def composite_md5(md5_list: list):
+    """
+    由各分片的md5合成整个文件的校验值(各分片md5拼接后再取md5，后缀为分片数)，不需要重新读取文件
+    :param md5_list: 按分片顺序排列的md5(十六进制)
+    """
+    m = hashlib.md5()
+    for md5 in md5_list:
+        m.update(bytes.fromhex(md5))
+    return '{}-{}'.format(m.hexdigest(), len(md5_list))
+
+
+def _copy_file_range(src_fd, dst_fd, count, dst_offset):
+    """
+    将src_fd的前count个字节复制到dst_fd的dst_offset处，依次尝试copy_file_range、sendfile和pwrite
+    """
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < count:
+                n = os.copy_file_range(src_fd, dst_fd, count - copied, copied, dst_offset + copied)
+                if n == 0:
+                    break
+                copied += n
+            return copied
+        except OSError:
+            # 跨文件系统或内核不支持时改用sendfile
+            pass
+
+    if hasattr(os, 'sendfile'):
+        try:
+            os.lseek(dst_fd, dst_offset + copied, os.SEEK_SET)
+            while copied < count:
+                n = os.sendfile(dst_fd, src_fd, copied, count - copied)
+                if n == 0:
+                    break
+                copied += n
+            return copied
+        except OSError:
+            pass
+
+    while copied < count:
+        data = os.pread(src_fd, min(1024 * 1024, count - copied), copied)
+        if not data:
+            break
+        os.pwrite(dst_fd, data, dst_offset + copied)
+        copied += len(data)
+    return copied
+
+
+def merge_files(sources: list, target: str):
+    """
+    按顺序拼接文件：预先为目标文件分配空间，分片内容在内核中直接复制，不经过Python缓冲区
+    :param sources: 按顺序排列的分片文件
+    :param target: 合并后的文件
+    :return: 合并后的文件大小
+    """
+    sizes = [os.path.getsize(source) for source in sources]
+    total = sum(sizes)
+    fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if total and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, total)
+            except OSError:
+                # 部分文件系统不支持预分配，直接写入即可
+                pass
+
+        offset = 0
+        for source, size in zip(sources, sizes):
+            with open(source, 'rb') as f:
+                copied = _copy_file_range(f.fileno(), fd, size, offset)
+            if copied != size:
+                raise IOError('chunk {} changed during merge, expect {} bytes, copied {}'.format(source, size, copied))
+            offset += size
+    finally:
+        os.close(fd)
+    return total
+
+
 def generate_random_str(length=32):
     """
     生成一个指定长度的随机字符串，其中
@@ -27,18 +135,81 @@ def generate_random_str(length=32):
     return random_str
 
 
+def version_compare(version1: str, version2: str):
+    """
+    比较版本号，与数据库中的version_compare函数逻辑一致
+    :return: -1表示version1 > version2，0表示相等，1表示version1 < version2
+    """
+    if version1 is None or version2 is None:
+        return None
+
+    parts1 = version1.split('.')
+    parts2 = version2.split('.')
+    loop_times = min(len(parts1), len(parts2))
+    compare_result = 0
+    for i in range(loop_times):
+        if parts1[i] == '*' or parts2[i] == '*':
+            compare_result = 0
+            continue
+
+        # 与LPAD(x, 32, '0')一致：不足32位左补0，超过32位截断
+        tmp_v1 = parts1[i].rjust(32, '0')[:32]
+        tmp_v2 = parts2[i].rjust(32, '0')[:32]
+        if tmp_v1 == tmp_v2:
+            compare_result = 0
+        else:
+            compare_result = 1 if tmp_v1 < tmp_v2 else -1
+
+        if i == loop_times - 1 and compare_result == 0:
+            if len(parts1) > len(parts2):
+                compare_result = -1
+            elif len(parts1) < len(parts2):
+                compare_result = 1
+
+        if compare_result != 0:
+            break
+    return compare_result
+
+
+def get_peak_rss_mb():
+    """
+    获取当前进程的内存峰值(MB)，不支持的平台返回None
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS下单位为字节，Linux下单位为KB
+    return round(max_rss / 1024 / (1024 if sys.platform == 'darwin' else 1), 1)
+
+
+def bind_sql_params(sql: str, params=()):
+    """
+    将参数代入带%s占位符的SQL，便于直接复制执行
+    :param sql: SQL语句
+    :param params: 参数
+    :return: 代入参数后的SQL
+    """
+    parts = sql.split('%s')
+    result = [parts[0]]
+    for i, part in enumerate(parts[1:]):
+        param = params[i] if params and i < len(params) else None
+        if param is None:
+            result.append('NULL')
+        elif isinstance(param, (int, float)) and not isinstance(param, bool):
+            result.append(str(param))
+        else:
+            result.append('\'{}\''.format(str(param).replace('\'', '\'\'')))
+        result.append(part)
+    return ''.join(result)
+
+
 def log2sql(log: str):
     datetime_pattern = r'(\d{4}-\d{1,2}-d{1,2}\s\d{1,2}:\d{1,2}:\d{1,2})'
     # datetime_repl = lambda x: '"{}"'.format(x.group())
     result = []
     for s in log.strip().split('\n'):
         sql, params = eval(s)
-        for param in params:
-            if isinstance(param, int):
-                sql = sql.replace('%s', str(param), 1)
-            else:
-                sql = sql.replace('%s', '\'{}\''.format(str(param)), 1)
-        sql = sql.replace("None", "NULL")
+        sql = bind_sql_params(sql, params)
         sql = re.sub(pattern=datetime_pattern, repl=lambda x: '"{}"'.format(x.group()), string=sql)
         result.append(sql)
     return result
@@ -1,39 +1,83 @@
 import logging
 import os
 import re
+import time
+from collections import namedtuple
 
 import yaml
 from peewee import *
-from playhouse.pool import PooledMySQLDatabase
 from playhouse.shortcuts import ThreadSafeDatabaseMetadata
+from pymysql.cursors import SSCursor
+
+from common_utils import get_peak_rss_mb, version_compare
+from db_metrics import query_metrics
+from db_router import ReplicaRouter
+from dbpool import db_pool, create_pool
+from log_utils import logger as app_logger
+
+
+class QueryMetricsMixin:
+    """
+    记录每条查询的耗时和行数
+    """
+
+    def execute(self, query, commit=None, **context_options):
+        ctx = self.get_sql_context(**context_options)
+        sql, params = ctx.sql(query).query()
+        start = time.perf_counter()
+        cursor = self.execute_sql(sql, params)
+        query_metrics.record(query_metrics.tag_of(query), sql, params, (time.perf_counter() - start) * 1000,
+                             cursor.rowcount)
+        return cursor
+
+
+class SharedPoolMySQLDatabase(QueryMetricsMixin, MySQLDatabase):
+    """
+    从dbpool的共享连接池取连接，与db_operator的原生SQL共用同一个池，close()时把连接归还给池
+    """
+
+    def __init__(self, pool, **kwargs):
+        self.pool = pool
+        super().__init__(pool.db, **kwargs)
+
+    def _connect(self):
+        return self.pool.checkout()
+
+    def _close(self, conn):
+        self.pool.checkin(conn)
+
+
+class MetricsSqliteDatabase(QueryMetricsMixin, SqliteDatabase):
+    pass
 
-import crypto_util
 
 pwd = os.path.split(os.path.realpath(__file__))[0]
 with open(''.join([pwd, '/', 'application.yaml']), 'r') as f:
     app_conf = yaml.safe_load(f)
     db_conf = app_conf['database']
-    host = db_conf['host']
-
-    port = db_conf['port']
-    user = db_conf['user']
-    password = db_conf['password']
-    if str.startswith(password, '{RSA}'):
-        sys_pub_key = db_conf['sys_pub_key']
-        app_pri_key = db_conf['app_pri_key']
-        password = crypto_util.decrypt(''.join([pwd, '/', sys_pub_key]), ''.join([pwd, '/', app_pri_key]),
-                                       bytes.fromhex(password[len('{RSA}'):]))
-    database = db_conf['db']
-    db = PooledMySQLDatabase(database,
-                             max_connections=32,
-                             host=host,
-                             port=port,
-                             user=user,
-                             password=password,
-                             charset='utf8mb4')
+    is_sqlite = db_conf.get('type') == 'sqlite'
+    if is_sqlite:
+        # 单机部署或本地性能测试使用，不依赖MySQL服务
+        sqlite_path = db_conf['sqlite_path']
+        db = MetricsSqliteDatabase(sqlite_path if os.path.isabs(sqlite_path) else ''.join([pwd, '/', sqlite_path]),
+                                   timeout=30,
+                                   pragmas={'journal_mode': 'wal', 'synchronous': 'normal', 'cache_size': -64000})
+        db.register_function(version_compare, 'version_compare', 2, deterministic=True)
+    else:
+        db = SharedPoolMySQLDatabase(db_pool)
+
+    # 从库未配置的连接参数(用户名、密码、库名、连接池等)与主库相同
+    replicas = [SharedPoolMySQLDatabase(create_pool({**db_conf, **replica_conf}, pwd))
+                for replica_conf in (db_conf.get('replicas') or [])] if not is_sqlite else []
+    replica_router = ReplicaRouter(db, replicas, max_lag=db_conf.get('replica_max_lag', 10),
+                                   check_interval=db_conf.get('replica_check_interval', 5))
+    read_replica = replica_router.read_replica
+    server_side_cursor = db_conf.get('server_side_cursor', False) and not is_sqlite
+    stream_batch_size = db_conf.get('stream_batch_size', 500)
 
     peewee_conf = app_conf['peewee']
     log_sql = peewee_conf['log_sql']
+    query_metrics.slow_query_ms = peewee_conf.get('slow_query_ms', query_metrics.slow_query_ms)
     if log_sql:
         logger = logging.getLogger('peewee')
         handler = logging.StreamHandler()
@@ -60,9 +104,78 @@ def make_table_name(model):
     return camel_to_snake(model_name)
 
 
+def seconds_ago(seconds: int):
+    """
+    数据库当前时间往前若干秒，可直接与时间字段比较以使用索引
+    """
+    if is_sqlite:
+        return fn.datetime('now', 'localtime', '-{} seconds'.format(seconds))
+    return fn.DATE_SUB(fn.NOW(), NodeList((SQL('INTERVAL'), seconds, SQL('SECOND'))))
+
+
+def days_from_today(days: int):
+    """
+    数据库当前日期加上若干天(可为负数)
+    """
+    if is_sqlite:
+        return fn.date('now', 'localtime', '{:+d} days'.format(days))
+    return fn.DATE_ADD(fn.CURDATE(), NodeList((SQL('INTERVAL'), days, SQL('DAY'))))
+
+
+def conflict_target(*fields):
+    """
+    upsert的冲突字段，SQLite必须指定，MySQL不允许指定
+    """
+    return list(fields) if is_sqlite else None
+
+
+def iterate_rows(query, label=None):
+    """
+    逐行读取查询结果(namedtuple)，开启server_side_cursor时使用服务端游标(SSCursor)按批读取，
+    客户端不再缓存整个结果集。注意：遍历结束前同一线程不能在该连接上执行其它查询
+    :param query: peewee查询
+    :param label: 日志中显示的查询名称
+    :return: 结果行迭代器
+    """
+    if not server_side_cursor:
+        yield from query.namedtuples().iterator()
+        return
+
+    label = label or query_metrics.tag_of(query)
+    sql, params = query.sql()
+    # 查询可能已被read_replica绑定到从库
+    cursor = (query._database or db).connection().cursor(SSCursor)
+    row_count = 0
+    batch_count = 0
+    start = time.perf_counter()
+    try:
+        cursor.execute(sql, params)
+        # 服务端游标只统计到开始返回结果为止的耗时，行数在遍历结束后记录
+        execute_ms = (time.perf_counter() - start) * 1000
+        row_type = namedtuple('Row', [column[0] for column in cursor.description], rename=True)
+        while True:
+            rows = cursor.fetchmany(stream_batch_size)
+            if not rows:
+                break
+            batch_count += 1
+            row_count += len(rows)
+            for row in rows:
+                yield row_type(*row)
+        query_metrics.record(query_metrics.tag_of(query), sql, params, execute_ms, row_count)
+    finally:
+        cursor.close()
+        app_logger.info('[{}] streamed {} rows in {} batches, peak rss {} MB'.format(
+            label, row_count, batch_count, get_peak_rss_mb()))
+
+
+# SQLite的CURRENT_TIMESTAMP为UTC时间，与MySQL保持一致使用本地时间
+DEFAULT_CURRENT_TIMESTAMP = (SQL("DEFAULT (datetime('now', 'localtime'))") if is_sqlite
+                             else SQL("DEFAULT current_timestamp()"))
+
+
 class BaseModel(Model):
-    create_time = DateTimeField(constraints=[SQL("DEFAULT current_timestamp()")])
-    update_time = DateTimeField(constraints=[SQL("DEFAULT current_timestamp()")])
+    create_time = DateTimeField(constraints=[DEFAULT_CURRENT_TIMESTAMP])
+    update_time = DateTimeField(constraints=[DEFAULT_CURRENT_TIMESTAMP])
 
     class Meta:
         database = db
@@ -90,6 +203,8 @@ class IdeVersion(BaseModel):
     version = CharField(null=True)
     last_sync_status = CharField(null=True)
     last_sync_time = DateTimeField(null=True)
+    # 该版本插件目录的版本号，目录内容变化时加1，用作目录缓存的generation
+    catalog_generation = BigIntegerField(constraints=[SQL("DEFAULT 0")], default=0)
 
     class Meta:
         indexes = (
@@ -145,7 +260,7 @@ class TmpTicket(BaseModel):
     ticket = CharField(primary_key=True)
     access_token = CharField()
     user_name = CharField(null=True)
-    step = IntegerField(constraints=[SQL("DEFAULT 0")])
+    step = IntegerField(constraints=[SQL("DEFAULT 1")], default=1)
 
 
 class VendorInfo(BaseModel):
@@ -169,12 +284,111 @@ class UploadBatchInfo(BaseModel):
     archive_suffix = CharField(null=True)
     since_build = CharField(null=True)
     until_build = CharField(null=True)
+    checksum = CharField(null=True)
+    # 客户端声明的分片数和文件大小，合并前据此检查分片是否完整，为空表示旧版客户端
+    chunk_count = IntegerField(null=True)
+    archive_size = BigIntegerField(null=True)
+    user_name = CharField(null=True)
 
 
 class UploadChunkInfo(BaseModel):
     batch_no = CharField()
     chunk_order = IntegerField(constraints=[SQL("DEFAULT 1")])
     saved_path = CharField()
+    checksum = CharField(null=True)
 
     class Meta:
         primary_key = CompositeKey('batch_no', 'chunk_order')
+
+
+class TmpSupportRotation(Model):
+    """
+    批量轮换support_version用的临时表，只存在于当前连接
+    """
+    id = CharField()
+    version = CharField()
+    base_version = CharField()
+
+    class Meta:
+        database = db
+        model_metadata_class = ThreadSafeDatabaseMetadata
+        table_name = 'tmp_support_rotation'
+        primary_key = False
+
+
+class SchemaMigration(BaseModel):
+    version = CharField(primary_key=True)
+    description = CharField(null=True)
+    checksum = CharField(null=True)
+
+
+class CatalogEntry(BaseModel):
+    """
+    每个IDE版本可用的白名单插件最新版本，冗余了生成updatePlugins.xml所需的全部字段，
+    由写入路径按IDE版本或插件增量维护，内容与server_dao.catalog_entry_source()的关联查询一致
+    """
+    product_code = CharField()
+    build_version = CharField()
+    id = CharField()
+    version = CharField()
+    name = CharField()
+    description = TextField(null=True)
+    change_notes = TextField(null=True)
+    since_build = CharField(null=True)
+    until_build = CharField(null=True)
+    rating = CharField(null=True)
+    archive_suffix = CharField(null=True)
+    vendor_name = CharField(null=True)
+    email = CharField(null=True)
+    url = CharField(null=True)
+    dev_type = CharField(null=True)
+
+    class Meta:
+        primary_key = CompositeKey('product_code', 'build_version', 'id', 'version')
+
+
+class BackgroundJob(BaseModel):
+    """
+    后台任务队列，status: pending/running/done/failed。
+    pending_key为合并键，只在pending状态时有值，同一合并键同时只有一个待执行的任务
+    """
+    id = AutoField()
+    job_type = CharField()
+    payload = TextField(null=True)
+    status = CharField(constraints=[SQL("DEFAULT 'pending'")], default='pending')
+    pending_key = CharField(null=True, unique=True)
+    attempts = IntegerField(default=0)
+    progress = IntegerField(default=0)
+    total = IntegerField(default=0)
+    message = TextField(null=True)
+    result = TextField(null=True)
+    run_after = DateTimeField(null=True)
+    lease_until = DateTimeField(null=True)
+
+
+ALL_MODELS = [DownloadInfo, IdeVersion, PluginsBaseInfo, PluginsVersionInfo, SupportVersion, SupportVersionHistory,
+              TmpTicket, VendorInfo, WhiteList, UploadBatchInfo, UploadChunkInfo, SchemaMigration, CatalogEntry,
+              BackgroundJob]
+
+# 与sql/migrations中的索引保持一致，用模型建表时一并创建
+SupportVersion.add_index(SupportVersion.index(SupportVersion.product_code, SupportVersion.build_version,
+                                              SupportVersion.latest_version, SupportVersion.id,
+                                              SupportVersion.version, name='idx_support_version_ide'))
+PluginsVersionInfo.add_index(PluginsVersionInfo.index(PluginsVersionInfo.update_time,
+                                                      name='idx_plugins_version_info_update_time'))
+PluginsVersionInfo.add_index(PluginsVersionInfo.index(PluginsVersionInfo.vendor_id,
+                                                      name='idx_plugins_version_info_vendor_id'))
+IdeVersion.add_index(IdeVersion.index(IdeVersion.create_time, name='idx_ide_version_create_time'))
+VendorInfo.add_index(VendorInfo.index(VendorInfo.name, name='idx_vendor_info_name'))
+TmpTicket.add_index(TmpTicket.index(TmpTicket.access_token, TmpTicket.create_time,
+                                    name='idx_tmp_ticket_access_token'))
+CatalogEntry.add_index(CatalogEntry.index(CatalogEntry.id, CatalogEntry.version, name='idx_catalog_entry_plugin'))
+# 过期数据清理按create_time分批查找
+SupportVersionHistory.add_index(SupportVersionHistory.index(SupportVersionHistory.create_time,
+                                                            name='idx_support_version_history_create_time'))
+TmpTicket.add_index(TmpTicket.index(TmpTicket.create_time, name='idx_tmp_ticket_create_time'))
+UploadBatchInfo.add_index(UploadBatchInfo.index(UploadBatchInfo.create_time, name='idx_upload_batch_info_create_time'))
+UploadChunkInfo.add_index(UploadChunkInfo.index(UploadChunkInfo.create_time, name='idx_upload_chunk_info_create_time'))
+BackgroundJob.add_index(BackgroundJob.index(BackgroundJob.status, BackgroundJob.run_after, name='idx_background_job_status'))
+# 插件搜索索引按create_time查找目录有变化的插件
+CatalogEntry.add_index(CatalogEntry.index(CatalogEntry.create_time, name='idx_catalog_entry_create_time'))
@@ -0,0 +1,115 @@
+import bisect
+import functools
+import threading
+
+from peewee import BaseQuery
+
+from common_utils import bind_sql_params
+from log_utils import logger, slow_query_logger
+
+# 延迟直方图的桶上限(毫秒)，最后一个桶收集超过5秒的查询
+LATENCY_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+class QueryStats:
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def add(self, elapsed_ms, rows):
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.rows += max(rows, 0)
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+
+    def percentile(self, ratio):
+        """
+        根据直方图估算分位数，返回所在桶的上限
+        """
+        threshold = self.count * ratio
+        accumulated = 0
+        for i, bucket_count in enumerate(self.buckets):
+            accumulated += bucket_count
+            if accumulated >= threshold:
+                return LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+
+class QueryMetrics:
+    """
+    按server_dao函数名统计查询延迟直方图和返回行数，超过阈值的查询连同参数写入慢查询日志
+    """
+
+    def __init__(self, slow_query_ms=500):
+        self.slow_query_ms = slow_query_ms
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def traced(self, func):
+        """
+        server_dao函数的装饰器：函数内执行的查询以函数名标记；
+        返回未执行的查询时把函数名记在查询对象上，调用方稍后执行时同样能归到该函数
+        """
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tags = self._local.__dict__.setdefault('tags', [])
+            tags.append(func.__name__)
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                tags.pop()
+            if isinstance(result, BaseQuery):
+                result.dao_tag = func.__name__
+            return result
+
+        return wrapper
+
+    def tag_of(self, query):
+        tag = getattr(query, 'dao_tag', None)
+        if tag is None:
+            tags = getattr(self._local, 'tags', None)
+            tag = tags[-1] if tags else 'untagged'
+        return tag
+
+    def record(self, tag, sql, params, elapsed_ms, rows):
+        with self._lock:
+            stats = self._stats.get(tag)
+            if stats is None:
+                stats = self._stats[tag] = QueryStats()
+            stats.add(elapsed_ms, rows)
+
+        if elapsed_ms >= self.slow_query_ms:
+            slow_query_logger.warning('[{}] {:.1f} ms, {} rows: {}'.format(tag, elapsed_ms, rows,
+                                                                          bind_sql_params(sql, params)))
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def summary(self, top_n=10):
+        """
+        按总耗时排序的前top_n个查询
+        :return: [(tag, QueryStats), ...]
+        """
+        with self._lock:
+            return sorted(self._stats.items(), key=lambda item: item[1].total_ms, reverse=True)[:top_n]
+
+    def log_summary(self, top_n=10):
+        lines = ['{:<48} {:>7} {:>11} {:>9} {:>9} {:>9} {:>9}'.format('query', 'count', 'total(ms)', 'avg(ms)',
+                                                                     'p95(ms)', 'max(ms)', 'rows')]
+        for tag, stats in self.summary(top_n):
+            lines.append('{:<48} {:>7} {:>11.1f} {:>9.1f} {:>9} {:>9.1f} {:>9}'.format(
+                tag, stats.count, stats.total_ms, stats.total_ms / stats.count, stats.percentile(0.95),
+                stats.max_ms, stats.rows))
+        logger.info('top {} queries by total time:\n{}'.format(top_n, '\n'.join(lines)))
+
+
+query_metrics = QueryMetrics()
+traced = query_metrics.traced
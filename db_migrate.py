@@ -0,0 +1,217 @@
+import argparse
+import hashlib
+import os
+import re
+import sys
+from pathlib import Path
+
+from peewee import DatabaseError
+
+import server_dao
+from data_access import db, is_sqlite, SchemaMigration, IdeVersion, PluginsVersionInfo, VendorInfo, TmpTicket, \
+    CatalogEntry
+from log_utils import logger
+
+MIGRATIONS_DIR = ''.join([os.path.split(os.path.realpath(__file__))[0], '/sql/migrations'])
+MIGRATION_FILE_PATTERN = re.compile(r'^V(\d+)__(\w+)\.sql$')
+
+# 重复执行DDL时数据库返回的错误：1050表已存在，1060字段已存在，1061索引已存在
+ALREADY_APPLIED_ERROR_CODES = (1050, 1060, 1061)
+# SQLite没有错误码，按错误信息判断
+ALREADY_APPLIED_MESSAGES = ('already exists', 'duplicate column name')
+
+
+def list_migrations():
+    """
+    按版本号排序列出sql/migrations下的迁移脚本
+    :return: [(version, description, path), ...]
+    """
+    migrations = []
+    for path in Path(MIGRATIONS_DIR).glob('V*.sql'):
+        matcher = MIGRATION_FILE_PATTERN.match(path.name)
+        if matcher:
+            migrations.append((matcher.group(1), matcher.group(2).replace('_', ' '), path))
+    return sorted(migrations, key=lambda item: int(item[0]))
+
+
+def split_statements(script: str):
+    lines = [line for line in script.splitlines() if not line.strip().startswith('--')]
+    return [statement.strip() for statement in '\n'.join(lines).split(';') if statement.strip()]
+
+
+def execute_ddl(statement: str):
+    """
+    执行单条DDL，对象已存在时视为已执行，保证迁移脚本可以重复执行
+    """
+    try:
+        db.execute_sql(statement)
+    except DatabaseError as e:
+        # peewee包装后的异常参数为(原始异常, 错误码, 错误信息)
+        error_code = e.args[1] if len(e.args) > 1 else None
+        if (error_code in ALREADY_APPLIED_ERROR_CODES
+                or any(message in str(e) for message in ALREADY_APPLIED_MESSAGES)):
+            logger.info('skip applied statement: {}'.format(e))
+        else:
+            raise
+
+
+def migrate():
+    db.create_tables([SchemaMigration], safe=True)
+    applied = {row.version: row for row in SchemaMigration.select()}
+
+    for version, description, path in list_migrations():
+        script = path.read_text(encoding='utf-8')
+        checksum = hashlib.md5(script.encode('utf-8')).hexdigest()
+        if version in applied:
+            if applied[version].checksum != checksum:
+                logger.warning('migration V{} has been modified after it was applied'.format(version))
+            continue
+
+        for statement in split_statements(script):
+            execute_ddl(statement)
+        SchemaMigration.create(version=version, description=description, checksum=checksum)
+        logger.info('migration V{} {} applied'.format(version, description))
+
+
+def status():
+    db.create_tables([SchemaMigration], safe=True)
+    applied = {row.version: row for row in SchemaMigration.select()}
+    for version, description, _ in list_migrations():
+        row = applied.get(version)
+        print('V{:<6} {:<40} {}'.format(version, description, row.create_time if row else 'pending'))
+
+
+def hot_queries():
+    """
+    高频DAO查询及其应当使用的索引，参数取库中已有的数据
+    :return: [(name, query, index_name), ...]
+    """
+    ide = IdeVersion.select().order_by(IdeVersion.create_time.desc()).first()
+    product_code, build_version = (ide.product_code, ide.build_version) if ide else ('IIC', '233.0')
+    vendor = VendorInfo.select().first()
+    vendor_id, vendor_name = (vendor.id, vendor.name) if vendor else ('', '')
+    ticket = TmpTicket.select().first()
+    access_token = ticket.access_token if ticket else ''
+
+    return [
+        ('get_latest_plugins_by_ide', server_dao.get_latest_plugins_by_ide(product_code, build_version),
+         # catalog_entry按主键(product_code, build_version, ...)读取
+         'sqlite_autoindex_catalog_entry_1' if is_sqlite else 'PRIMARY'),
+        ('get_download_info_by_ide', server_dao.get_download_info_by_ide(product_code, build_version),
+         'idx_support_version_ide'),
+        ('get_recent_released_plugins', server_dao.get_recent_released_plugins(),
+         'idx_plugins_version_info_update_time'),
+        ('get_vendor_info_by_name', VendorInfo.select().where(VendorInfo.name == vendor_name),
+         'idx_vendor_info_name'),
+        ('get_valid_tmp_ticket', server_dao.get_valid_tmp_ticket(access_token), 'idx_tmp_ticket_access_token'),
+        ('plugins_version_info by vendor',
+         PluginsVersionInfo.select().where(PluginsVersionInfo.vendor_id == vendor_id),
+         'idx_plugins_version_info_vendor_id'),
+    ]
+
+
+def explain():
+    """
+    对高频查询执行EXPLAIN，检查是否使用了预期的索引。
+    表中数据过少时优化器可能选择全表扫描，应在有真实数据的库上检查
+    :return: 全部使用预期索引时返回True
+    """
+    all_used = True
+    for name, query, index_name in hot_queries():
+        sql, params = query.sql()
+        if is_sqlite:
+            # SQLite的执行计划中使用索引时detail形如"SEARCH t USING INDEX idx_xxx (...)"
+            cursor = db.execute_sql(''.join(['EXPLAIN QUERY PLAN ', sql]), params)
+            used_keys = [key for row in cursor.fetchall() for key in re.findall(r'INDEX (\w+)', row[-1])]
+        else:
+            cursor = db.execute_sql(''.join(['EXPLAIN ', sql]), params)
+            columns = [column[0] for column in cursor.description]
+            used_keys = [row[columns.index('key')] for row in cursor.fetchall() if row[columns.index('key')]]
+        used = index_name in used_keys
+        all_used = all_used and used
+        print('{:<4} {:<45} expect {:<40} used {}'.format('OK' if used else 'MISS', name, index_name,
+                                                          ', '.join(used_keys) or '-'))
+    return all_used
+
+
+def verify_catalog(sample_size=10):
+    """
+    按产品比较catalog_entry与关联查询的结果，输出缺失、多余和内容不一致的记录
+    :param sample_size: 每类差异最多输出的记录数
+    :return: 完全一致时返回True
+    """
+    missing, extra, different = [], [], []
+    entry_count = 0
+    for row in IdeVersion.select(IdeVersion.product_code).distinct():
+        expected = {entry[:4]: entry for entry in server_dao.catalog_entry_source(product_code=row.product_code)
+                    .tuples()}
+        actual = {entry[:4]: entry for entry in CatalogEntry.select(*server_dao.CATALOG_ENTRY_FIELDS)
+                  .where(CatalogEntry.product_code == row.product_code).tuples()}
+        entry_count += len(actual)
+        missing.extend(key for key in expected.keys() - actual.keys())
+        extra.extend(key for key in actual.keys() - expected.keys())
+        different.extend(key for key in expected.keys() & actual.keys() if expected[key] != actual[key])
+
+    print('catalog_entry: {} rows, {} missing, {} extra, {} different'.format(entry_count, len(missing), len(extra),
+                                                                              len(different)))
+    for title, keys in (('missing', missing), ('extra', extra), ('different', different)):
+        for key in sorted(keys)[:sample_size]:
+            print('  {:<10} {}'.format(title, ' '.join(key)))
+    return not (missing or extra or different)
+
+
+def toggle_white_list(plugin_id: str, enabled: str):
+    """
+    启用或停用白名单插件，并检查该插件变化前后所在的IDE版本的目录版本号都已增加，
+    版本号增加后各进程重新生成这些目录，updatePlugins.xml的内容和ETag随之更新
+    :return: 受影响的目录都已更新时返回True
+    """
+    def plugin_catalogs():
+        return set(CatalogEntry.select(CatalogEntry.product_code, CatalogEntry.build_version)
+                   .where(CatalogEntry.id == plugin_id).distinct().tuples())
+
+    def generations():
+        return {(row.product_code, row.build_version): row.catalog_generation
+                for row in IdeVersion.select(IdeVersion.product_code, IdeVersion.build_version,
+                                             IdeVersion.catalog_generation)}
+
+    before_catalogs, before_generations = plugin_catalogs(), generations()
+    server_dao.set_white_list(plugin_id, enabled)
+    after_catalogs, after_generations = plugin_catalogs(), generations()
+
+    affected = before_catalogs | after_catalogs
+    stale = sorted(key for key in affected if after_generations.get(key, 0) <= before_generations.get(key, 0))
+    print('{} {}: {} -> {} catalogs, {} regenerated, {} stale'.format(
+        'enabled' if enabled == '1' else 'disabled', plugin_id, len(before_catalogs), len(after_catalogs),
+        len(affected) - len(stale), len(stale)))
+    for key in stale:
+        print('  stale      {}'.format(' '.join(key)))
+    return not stale
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='database schema migration')
+    parser.add_argument('command', nargs='?', default='migrate',
+                        choices=['migrate', 'status', 'explain', 'catalog-verify', 'catalog-rebuild', 'whitelist'])
+    parser.add_argument('--plugin', action='append', dest='plugin_ids',
+                        help='catalog-rebuild: only rebuild these plugins; whitelist: plugin id')
+    parser.add_argument('--disable', action='store_true', help='whitelist: disable the plugin')
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        migrate()
+    elif args.command == 'status':
+        status()
+    elif args.command == 'catalog-verify':
+        if not verify_catalog():
+            sys.exit(1)
+    elif args.command == 'catalog-rebuild':
+        print('{} catalog entries written'.format(server_dao.refresh_catalog_entries(plugin_ids=args.plugin_ids)))
+    elif args.command == 'whitelist':
+        if not args.plugin_ids:
+            parser.error('--plugin is required')
+        results = [toggle_white_list(plugin_id, '0' if args.disable else '1') for plugin_id in args.plugin_ids]
+        if not all(results):
+            sys.exit(1)
+    elif not explain():
+        sys.exit(1)
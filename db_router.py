@@ -0,0 +1,164 @@
+import functools
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+from pymysql.constants import ER
+from pymysql.cursors import DictCursor
+from pymysql.err import ProgrammingError
+
+from log_utils import logger
+
+
+class ReplicaRouter:
+    """
+    读写分离：只读查询轮询分配到延迟未超过阈值的从库，没有可用从库时回退到主库
+    """
+
+    def __init__(self, primary, replicas=None, max_lag=10, check_interval=5):
+        """
+        :param primary: 主库(peewee Database)
+        :param replicas: 从库列表，元素为使用共享连接池的peewee Database(带pool属性)
+        :param max_lag: 允许的最大复制延迟秒数，超过时该从库不参与读请求
+        :param check_interval: 复制延迟的检查间隔秒数，期间使用上次的检查结果
+        """
+        self.primary = primary
+        self.replicas = list(replicas or [])
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+        self._lag = {}  # id(replica) -> (checked_at, lag)，lag为None表示不可用
+        self._local = threading.local()
+        self._routed = {'primary': 0, 'replica': 0, 'fallback': 0}
+
+    @staticmethod
+    def _replica_status(conn):
+        """
+        MySQL 8.0.22起为SHOW REPLICA STATUS，8.4移除了SHOW SLAVE STATUS；更早的版本只支持旧语法
+        """
+        with conn.cursor(DictCursor) as cursor:
+            try:
+                cursor.execute('SHOW REPLICA STATUS')
+                return cursor.fetchone()
+            except ProgrammingError as e:
+                if e.args[0] != ER.PARSE_ERROR:
+                    raise
+            cursor.execute('SHOW SLAVE STATUS')
+            return cursor.fetchone()
+
+    @classmethod
+    def _probe_lag(cls, replica):
+        """
+        查询从库的复制延迟，连接从库的用户需要REPLICATION CLIENT权限
+        :return: 延迟秒数，复制中断或无法连接时返回None
+        """
+        address = '{}:{}'.format(replica.pool.host, replica.pool.port)
+        try:
+            with replica.pool.connection() as conn:
+                status = cls._replica_status(conn)
+        except Exception as e:
+            if e.args and e.args[0] == ER.SPECIFIC_ACCESS_DENIED_ERROR:
+                logger.warning('replica {} is unavailable: grant REPLICATION CLIENT to the database user '
+                               'to check replication lag'.format(address))
+            else:
+                logger.warning('replica {} is unavailable: {}'.format(address, e))
+            return None
+        if not status:
+            logger.warning('replica {} is not replicating'.format(address))
+            return None
+        # MariaDB的SHOW REPLICA STATUS仍使用Seconds_Behind_Master
+        return status.get('Seconds_Behind_Source', status.get('Seconds_Behind_Master'))
+
+    def replica_lag(self, replica, refresh=False):
+        now = time.monotonic()
+        with self._lock:
+            checked_at, lag = self._lag.get(id(replica), (None, None))
+        if refresh or checked_at is None or now - checked_at >= self.check_interval:
+            lag = self._probe_lag(replica)
+            with self._lock:
+                self._lag[id(replica)] = (now, lag)
+        return lag
+
+    def _available(self, replica):
+        lag = self.replica_lag(replica)
+        return lag is not None and lag <= self.max_lag
+
+    def choose(self):
+        """
+        为只读查询选择数据库。主库处于事务中或显式要求读主库时，为保证读到本线程刚写入的数据，直接使用主库
+        """
+        if (not self.replicas or getattr(self._local, 'primary_only', False)
+                or self.primary.in_transaction()):
+            self._count('primary')
+            return self.primary
+
+        start = next(self._counter)
+        for i in range(len(self.replicas)):
+            replica = self.replicas[(start + i) % len(self.replicas)]
+            if self._available(replica):
+                self._count('replica')
+                return replica
+
+        self._count('fallback')
+        return self.primary
+
+    def _count(self, route):
+        with self._lock:
+            self._routed[route] += 1
+
+    @contextmanager
+    def primary_reads(self):
+        """
+        在该上下文中当前线程的只读查询全部使用主库，用于写入后需要立即读到最新数据的场景
+        """
+        previous = getattr(self._local, 'primary_only', False)
+        self._local.primary_only = True
+        try:
+            yield
+        finally:
+            self._local.primary_only = previous
+
+    def wait_for_replicas(self, timeout=30, poll_interval=1):
+        """
+        等待从库追上主库(延迟为0)，超时后延迟超过阈值的从库仍会被跳过
+        :return: 全部从库已追上时返回True
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            lags = [self.replica_lag(replica, refresh=True) for replica in self.replicas]
+            if all(lag == 0 for lag in lags):
+                return True
+            if time.monotonic() >= deadline:
+                logger.warning('replicas are still behind after {}s, lag: {}'.format(timeout, lags))
+                return False
+            time.sleep(poll_interval)
+
+    def read_replica(self, func):
+        """
+        DAO函数装饰器，函数返回的查询绑定到选中的数据库，执行时才会取连接
+        """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return func(*args, **kwargs).bind(self.choose())
+
+        return wrapper
+
+    def close(self):
+        """
+        归还当前线程在主库和从库上持有的连接
+        """
+        for database in [self.primary] + self.replicas:
+            if not database.is_closed():
+                database.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'replicas': len(self.replicas),
+                'routed': dict(self._routed),
+                'lag': {'{}:{}'.format(replica.pool.host, replica.pool.port): self._lag.get(id(replica), (None, None))[1]
+                        for replica in self.replicas},
+            }
@@ -1,32 +1,232 @@
-from dbutils.pooled_db import PooledDB
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
 import pymysql
+import yaml
+
+import crypto_util
+from log_utils import logger
+
+
+class PoolTimeoutError(RuntimeError):
+    pass
 
 
 class DBPool:
-    def __init__(self, host, port, user, password, db, charset='utf8mb4', min_cached=0, max_cached=0, max_shared=0,
-                 max_connections=0):
+    """
+    MySQL连接池，peewee(data_access)和原生SQL(db_operator)共用
+    """
+
+    def __init__(self, host, port, user, password, db, charset='utf8mb4', min_idle=0, max_idle=8,
+                 max_connections=32, max_age=3600, pre_ping=True, checkout_timeout=30, slow_checkout_ms=1000):
+        """
+        :param min_idle: 首次取连接时预先建立的空闲连接数
+        :param max_idle: 归还时保留的最大空闲连接数，超出的连接直接关闭
+        :param max_connections: 最大连接数(使用中+空闲)，达到上限后取连接需要等待
+        :param max_age: 连接最长存活秒数，超时的连接在取出或归还时关闭，0表示不限制
+        :param pre_ping: 取出空闲连接前是否先ping一次
+        :param checkout_timeout: 取连接的最长等待秒数
+        :param slow_checkout_ms: 取连接等待超过该毫秒数时记录告警日志
+        """
         self.host = host
         self.port = port
         self.user = user
         self.password = password
         self.db = db
         self.charset = charset
-        self.min_cached = min_cached if min_cached > 0 else 0
-        self.max_cached = max_cached if max_cached > 0 else 0
-        self.max_shared = max_shared if max_shared > 0 else 0
-        self.max_connections = max_connections if max_connections > 0 else 0
-
-        self.pool = PooledDB(creator=pymysql,
-                             mincached=self.min_cached,
-                             maxcached=self.max_cached,
-                             maxshared=self.max_shared,
-                             maxconnections=self.max_connections,
-                             host=self.host,
-                             port=self.port,
-                             user=self.user,
-                             password=self.password,
-                             db=self.db,
-                             charset=self.charset)
-
-    def conn(self):
-        return self.pool.connection()
+        self.min_idle = max(min_idle, 0)
+        self.max_idle = max(max_idle, self.min_idle)
+        self.max_connections = max(max_connections, 1)
+        self.max_age = max_age
+        self.pre_ping = pre_ping
+        self.checkout_timeout = checkout_timeout
+        self.slow_checkout_ms = slow_checkout_ms
+
+        self._idle = deque()  # (conn, created_at)
+        self._created_at = {}  # id(conn) -> created_at
+        self._total = 0  # 已建立(含正在建立)的连接数
+        self._in_use = 0
+        self._warmed_up = False
+        self._cond = threading.Condition()
+
+        self._checkouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._timeouts = 0
+        self._opened = 0
+        self._closed = 0
+        self._peak_in_use = 0
+
+    def _open(self):
+        """
+        在锁外建立连接，调用前需已占用一个连接数名额
+        """
+        try:
+            conn = pymysql.connect(host=self.host, port=self.port, user=self.user, password=self.password,
+                                   database=self.db, charset=self.charset, autocommit=True)
+        except Exception:
+            with self._cond:
+                self._total -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._opened += 1
+            self._created_at[id(conn)] = time.monotonic()
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._created_at.pop(id(conn), None)
+            self._total -= 1
+            self._closed += 1
+            self._cond.notify()
+
+    def _expired(self, created_at):
+        return self.max_age and time.monotonic() - created_at > self.max_age
+
+    def _warm_up(self):
+        with self._cond:
+            if self._warmed_up:
+                return
+            self._warmed_up = True
+        for _ in range(self.min_idle):
+            with self._cond:
+                if self._total >= self.max_connections:
+                    break
+                self._total += 1
+            conn = self._open()
+            with self._cond:
+                self._idle.append((conn, self._created_at[id(conn)]))
+                self._cond.notify()
+
+    def checkout(self):
+        """
+        取出一个连接，用完后必须调用checkin归还
+        :return: pymysql连接
+        """
+        if not self._warmed_up:
+            self._warm_up()
+
+        start = time.monotonic()
+        deadline = start + self.checkout_timeout
+        while True:
+            with self._cond:
+                while not self._idle and self._total >= self.max_connections:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeoutError('no database connection available in {}s'.format(
+                            self.checkout_timeout))
+                    self._cond.wait(remaining)
+
+                if self._idle:
+                    conn, created_at = self._idle.pop()  # 后进先出，优先复用最近使用过的连接
+                else:
+                    conn, created_at = None, None
+                    self._total += 1
+                self._in_use += 1
+
+            if conn is None:
+                try:
+                    conn = self._open()
+                except Exception:
+                    with self._cond:
+                        self._in_use -= 1
+                    raise
+            elif self._expired(created_at) or (self.pre_ping and not self._ping(conn)):
+                with self._cond:
+                    self._in_use -= 1
+                self._discard(conn)
+                continue
+            break
+
+        waited = time.monotonic() - start
+        with self._cond:
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+            self._peak_in_use = max(self._peak_in_use, self._in_use)
+        if waited * 1000 > self.slow_checkout_ms:
+            logger.warning('waited {:.0f} ms for a database connection, pool stats: {}'.format(
+                waited * 1000, self.stats()))
+        return conn
+
+    @staticmethod
+    def _ping(conn):
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    def checkin(self, conn):
+        """
+        归还连接
+        :param conn: checkout取出的连接
+        """
+        with self._cond:
+            self._in_use -= 1
+            created_at = self._created_at.get(id(conn))
+            keep = (created_at is not None and conn.open and not self._expired(created_at)
+                    and len(self._idle) < self.max_idle)
+            if keep:
+                self._idle.append((conn, created_at))
+                self._cond.notify()
+        if not keep:
+            self._discard(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.checkout()
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
+
+    def stats(self):
+        """
+        连接池统计信息：使用率、取连接等待时间和连接新建/关闭次数
+        """
+        with self._cond:
+            return {
+                'max_connections': self.max_connections,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'peak_in_use': self._peak_in_use,
+                'utilization': round(self._in_use / self.max_connections, 2),
+                'checkouts': self._checkouts,
+                'wait_avg_ms': round(self._wait_total * 1000 / self._checkouts, 2) if self._checkouts else 0,
+                'wait_max_ms': round(self._wait_max * 1000, 2),
+                'timeouts': self._timeouts,
+                'opened': self._opened,
+                'closed': self._closed,
+            }
+
+
+def create_pool(db_conf, conf_dir):
+    """
+    根据application.yaml中的database配置创建连接池，密码以{RSA}开头时先解密
+    :param db_conf: database配置
+    :param conf_dir: 密钥文件的相对目录
+    :return: DBPool
+    """
+    password = db_conf['password']
+    if str.startswith(password, '{RSA}'):
+        sys_pub_key = db_conf['sys_pub_key']
+        app_pri_key = db_conf['app_pri_key']
+        password = crypto_util.decrypt(''.join([conf_dir, '/', sys_pub_key]), ''.join([conf_dir, '/', app_pri_key]),
+                                       bytes.fromhex(password[len('{RSA}'):]))
+    return DBPool(db_conf['host'], db_conf['port'], db_conf['user'], password, db_conf['db'],
+                  **db_conf.get('pool', {}))
+
+
+pwd = os.path.split(os.path.realpath(__file__))[0]
+with open(''.join([pwd, '/', 'application.yaml']), 'r') as f:
+    db_pool = create_pool(yaml.safe_load(f)['database'], pwd)
@@ -0,0 +1,88 @@
+import bisect
+import threading
+import time
+from collections import namedtuple
+
+import server_dao
+from data_access import app_conf
+from log_utils import logger
+
+IdeBuild = namedtuple('IdeBuild', ['product_code', 'build_version', 'version', 'create_time'])
+
+# 通配符'*'在下界中小于、在上界中大于任意版本段
+MIN_SEGMENT = ''
+MAX_SEGMENT = '\uffff'
+
+
+def build_key(build_version: str, wildcard: str = MIN_SEGMENT):
+    """
+    将版本号转换为可直接比较大小的元组，与数据库中version_compare的比较结果一致：
+    各段左补0到32位后逐段比较，前面各段相同时段数多的版本更大
+    :param build_version: 版本号，如233.11799.241
+    :param wildcard: 遇到'*'时使用的段值，并忽略其后的各段
+    :return: 元组
+    """
+    key = []
+    for segment in build_version.split('.'):
+        if segment == '*':
+            key.append(wildcard)
+            break
+        key.append(segment.rjust(32, '0')[:32])
+    return tuple(key)
+
+
+class IdeBuildIndex:
+    """
+    按版本号排序的IDE构建版本索引，用二分查找代替数据库中逐行调用version_compare的范围查询。
+    IDE版本很少变化，加载后在ttl秒内直接使用，新增IDE版本后调用refresh立即生效
+    """
+
+    def __init__(self, loader, ttl=300):
+        """
+        :param loader: 返回全部IDE版本(product_code, build_version, version, create_time)的查询函数
+        :param ttl: 自动重新加载的间隔秒数，用于感知其它进程新增的IDE版本
+        """
+        self.loader = loader
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._keys = []
+        self._builds = []
+        self._loaded_at = None
+
+    def refresh(self):
+        start = time.perf_counter()
+        builds = sorted(((build_key(row.build_version), IdeBuild(row.product_code, row.build_version, row.version,
+                                                                   row.create_time))
+                         for row in self.loader().namedtuples().iterator()), key=lambda item: item[0])
+        with self._lock:
+            self._keys = [key for key, _ in builds]
+            self._builds = [build for _, build in builds]
+            self._loaded_at = time.monotonic()
+        logger.info('ide build index loaded {} builds in {:.1f} ms'.format(len(builds),
+                                                                          (time.perf_counter() - start) * 1000))
+
+    def _snapshot(self):
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl:
+            self.refresh()
+        with self._lock:
+            return self._keys, self._builds
+
+    def builds_between(self, since_build: str = None, until_build: str = None, created_after=None):
+        """
+        查询版本号在[since_build, until_build]范围内的IDE版本
+        :param since_build: 最低版本，为空表示不限制
+        :param until_build: 最高版本，为空表示不限制
+        :param created_after: 只返回该时间之后新增的IDE版本
+        :return: [IdeBuild, ...]，按版本号从高到低排序
+        """
+        keys, builds = self._snapshot()
+        low = bisect.bisect_left(keys, build_key(since_build, MIN_SEGMENT)) if since_build else 0
+        high = bisect.bisect_right(keys, build_key(until_build, MAX_SEGMENT)) if until_build else len(keys)
+        return [build for build in reversed(builds[low:high])
+                if created_after is None or (build.create_time and build.create_time >= created_after)]
+
+    def __len__(self):
+        return len(self._snapshot()[0])
+
+
+ide_index = IdeBuildIndex(server_dao.get_ide_versions, ttl=app_conf.get('ide_index', {}).get('ttl', 300))
@@ -0,0 +1,175 @@
+import datetime
+import json
+import os
+import threading
+import time
+
+import server_dao
+from log_utils import logger
+
+
+class JobContext:
+    """
+    传给任务处理函数，用于上报进度和保存已完成的步骤，上报进度时同时续租
+    """
+
+    def __init__(self, queue, job):
+        self.queue = queue
+        self.job = job
+
+    def progress(self, done: int, total: int, message: str = None):
+        server_dao.update_job(self.job.id, progress=done, total=total, message=message,
+                              lease_until=datetime.datetime.now() + datetime.timedelta(
+                                  seconds=self.queue.lease_seconds))
+
+    def checkpoint(self, payload: dict):
+        """
+        保存任务参数及已完成步骤的结果，任务失败重试时处理函数据此跳过已完成且不能重复执行的步骤
+        """
+        server_dao.update_job(self.job.id, payload=json.dumps(payload))
+
+
+class JobHeartbeat:
+    """
+    任务执行期间按租约的三分之一定期续租，耗时的步骤(如上传Nexus)没有上报进度时也不会被其它执行者重复领取
+    """
+
+    def __init__(self, job_id: int, lease_seconds: int):
+        self.job_id = job_id
+        self.lease_seconds = lease_seconds
+        self.interval = max(1, lease_seconds // 3)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name='job-heartbeat-{}'.format(self.job_id), daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                server_dao.renew_job_lease(self.job_id, self.lease_seconds)
+            except Exception as e:
+                logger.exception('renew lease of job {} failed'.format(self.job_id), e)
+            finally:
+                server_dao.replica_router.close()
+
+
+class JobQueue:
+    """
+    基于数据库的后台任务队列，任务在提交时写入background_job表，服务重启后未完成的任务会继续执行。
+    多个进程可以同时消费同一个队列，按租约领取任务，执行者异常退出后任务在租约到期后被重新领取
+    """
+
+    def __init__(self, workers=2, poll_interval=1.0, lease_seconds=600, max_attempts=3, retry_delay=30):
+        """
+        :param workers: 执行任务的线程数
+        :param poll_interval: 没有任务时的轮询间隔秒数
+        :param lease_seconds: 领取任务的租约秒数，执行期间自动续租，执行者异常退出后租约到期的任务会被重新领取
+        :param max_attempts: 最多执行次数，失败次数达到后标记为failed
+        :param retry_delay: 失败后重试的间隔秒数，按执行次数递增
+        """
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+        self._handlers = {}
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def register(self, job_type: str, handler):
+        """
+        注册任务处理函数
+        :param job_type: 任务类型
+        :param handler: handler(payload: dict, context: JobContext)，返回值作为任务结果保存
+        """
+        self._handlers[job_type] = handler
+
+    def submit(self, job_type: str, payload: dict, coalesce_key: str = None):
+        """
+        提交任务，coalesce_key相同且尚未开始执行的任务会合并为一个
+        :return: (任务id, 是否合并到已有任务)
+        """
+        job_id, coalesced = server_dao.enqueue_job(job_type, json.dumps(payload), coalesce_key)
+        logger.info('job {} [{}] {}'.format(job_id, job_type, 'coalesced' if coalesced else 'submitted'))
+        self._wakeup.set()
+        return job_id, coalesced
+
+    def status(self, job_id: int):
+        job = server_dao.get_job(job_id)
+        if job is None:
+            return None
+        return {
+            'id': job.id,
+            'type': job.job_type,
+            'status': job.status,
+            'progress': job.progress,
+            'total': job.total,
+            'message': job.message,
+            'attempts': job.attempts,
+            'result': json.loads(job.result) if job.result else None,
+            'create_time': str(job.create_time),
+            'update_time': str(job.update_time),
+        }
+
+    def start(self):
+        if self._threads or self.workers <= 0:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name='job-worker-{}-{}'.format(os.getpid(), i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info('job queue started with {} workers'.format(self.workers))
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                job = server_dao.claim_job(self.lease_seconds)
+                if job is None:
+                    self._wakeup.wait(self.poll_interval)
+                    self._wakeup.clear()
+                    continue
+                self.execute(job)
+            except Exception as e:
+                logger.exception('job worker error', e)
+                time.sleep(self.poll_interval)
+            finally:
+                # 工作线程空闲时不占用连接池
+                server_dao.replica_router.close()
+
+    def execute(self, job):
+        handler = self._handlers.get(job.job_type)
+        start = time.perf_counter()
+        try:
+            if handler is None:
+                raise ValueError('unknown job type {}'.format(job.job_type))
+            with JobHeartbeat(job.id, self.lease_seconds):
+                result = handler(json.loads(job.payload) if job.payload else {}, JobContext(self, job))
+        except Exception as e:
+            logger.exception('job {} [{}] attempt {} failed'.format(job.id, job.job_type, job.attempts), e)
+            if job.attempts < self.max_attempts and handler is not None:
+                server_dao.update_job(job.id, status='pending', message=str(e), lease_until=None,
+                                      run_after=datetime.datetime.now() + datetime.timedelta(
+                                          seconds=self.retry_delay * job.attempts))
+            else:
+                server_dao.update_job(job.id, status='failed', message=str(e), lease_until=None)
+            return
+
+        server_dao.update_job(job.id, status='done', lease_until=None,
+                              result=json.dumps(result) if result is not None else None)
+        logger.info('job {} [{}] done in {:.1f}s'.format(job.id, job.job_type, time.perf_counter() - start))
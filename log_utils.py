@@ -9,4 +9,14 @@ logger.add('{}/logs/plugins_sync.log'.format(os.path.split(os.path.realpath(__fi
            rotation='00:00',
            retention='7 days',
            delay=True,
-           level='INFO')
+           level='INFO',
+           filter=lambda record: 'slow_query' not in record['extra'])
+logger.add('{}/logs/slow_query.log'.format(os.path.split(os.path.realpath(__file__))[0]),
+           enqueue=True,
+           rotation='00:00',
+           retention='7 days',
+           delay=True,
+           level='INFO',
+           filter=lambda record: 'slow_query' in record['extra'])
+
+slow_query_logger = logger.bind(slow_query=True)
@@ -0,0 +1,140 @@
+import argparse
+import csv
+import datetime
+import gzip
+import os
+import re
+import shutil
+import time
+from pathlib import Path
+
+import server_dao
+from data_access import app_conf, SupportVersionHistory, TmpTicket, UploadBatchInfo, UploadChunkInfo
+from log_utils import logger
+
+# 分片目录以上传批次号命名(旧版本以上传票据命名)，均为common_utils.generate_random_str生成的32位字母数字
+CHUNK_DIR_PATTERN = re.compile(r'^[0-9A-Za-z]{32}$')
+
+
+class Maintenance:
+
+    def __init__(self, conf=None, dry_run=False):
+        conf = conf or app_conf['maintenance']
+        self.batch_size = conf['batch_size']
+        self.batch_pause = conf['batch_pause_ms'] / 1000
+        self.support_version_history_days = conf['support_version_history_days']
+        self.tmp_ticket_hours = conf['tmp_ticket_hours']
+        self.upload_info_days = conf['upload_info_days']
+        self.chunk_dir_hours = conf['chunk_dir_hours']
+        self.archive_dir = conf.get('archive_dir')
+        self.upload_dir = app_conf['upload_dir']
+        self.dry_run = dry_run
+
+    def purge(self, model, before, archive_file=None):
+        """
+        分批删除早于指定时间创建的记录，每批按主键删除后单独提交，避免长时间锁表
+        :param model: 模型
+        :param before: 早于该时间创建的记录视为过期
+        :param archive_file: 删除前将记录追加到该gzip压缩的csv文件，为空不导出
+        :return: 删除的记录数
+        """
+        if self.dry_run:
+            expired = server_dao.count_expired_rows(model, before)
+            logger.info('[{}] {} rows created before {} would be purged'.format(model._meta.table_name, expired,
+                                                                               before))
+            return expired
+
+        fields = [field.name for field in model._meta.sorted_fields]
+        deleted = 0
+        batch_count = 0
+        while True:
+            rows = list(server_dao.get_expired_rows(model, before, self.batch_size))
+            if not rows:
+                break
+
+            if archive_file:
+                self.archive(archive_file, fields, rows)
+            deleted += server_dao.delete_rows_by_key(model, rows)
+            batch_count += 1
+            if len(rows) < self.batch_size:
+                break
+            time.sleep(self.batch_pause)
+
+        logger.info('[{}] purged {} rows created before {} in {} batches'.format(model._meta.table_name, deleted,
+                                                                                before, batch_count))
+        return deleted
+
+    @staticmethod
+    def archive(archive_file, fields, rows):
+        write_header = not os.path.exists(archive_file)
+        with gzip.open(archive_file, 'at', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            if write_header:
+                writer.writerow(fields)
+            writer.writerows([[getattr(row, field) for field in fields] for row in rows])
+
+    def clean_chunk_dirs(self, before):
+        """
+        删除未合并的分片目录：以票据命名、只包含文件且最后修改时间早于指定时间的目录
+        :return: (删除的目录数, 释放的字节数)
+        """
+        upload_dir = Path(self.upload_dir)
+        if not upload_dir.is_dir():
+            return 0, 0
+
+        removed = 0
+        freed = 0
+        for chunk_dir in upload_dir.iterdir():
+            if not chunk_dir.is_dir() or not CHUNK_DIR_PATTERN.match(chunk_dir.name):
+                continue
+            files = list(chunk_dir.iterdir())
+            # 插件目录下是版本目录，分片目录下只有分片文件
+            if any(file.is_dir() for file in files):
+                continue
+            if datetime.datetime.fromtimestamp(chunk_dir.stat().st_mtime) >= before:
+                continue
+
+            size = sum(file.stat().st_size for file in files)
+            logger.info('remove orphan chunk dir {} ({} files, {} bytes)'.format(chunk_dir, len(files), size))
+            if not self.dry_run:
+                shutil.rmtree(chunk_dir)
+            removed += 1
+            freed += size
+        return removed, freed
+
+    def run(self):
+        now = datetime.datetime.now()
+        start = time.perf_counter()
+
+        # 先清理分片目录，再删除分片记录
+        if self.chunk_dir_hours:
+            removed, freed = self.clean_chunk_dirs(now - datetime.timedelta(hours=self.chunk_dir_hours))
+            logger.info('removed {} orphan chunk dirs, {:.1f} MB freed'.format(removed, freed / 1024 / 1024))
+
+        if self.support_version_history_days:
+            archive_file = None
+            if self.archive_dir and not self.dry_run:
+                Path(self.archive_dir).mkdir(parents=True, exist_ok=True)
+                archive_file = ''.join([self.archive_dir, '/support_version_history-', now.strftime('%Y%m%d%H%M%S'),
+                                        '.csv.gz'])
+            self.purge(SupportVersionHistory, now - datetime.timedelta(days=self.support_version_history_days),
+                       archive_file)
+
+        if self.tmp_ticket_hours:
+            self.purge(TmpTicket, now - datetime.timedelta(hours=self.tmp_ticket_hours))
+
+        if self.upload_info_days:
+            before = now - datetime.timedelta(days=self.upload_info_days)
+            self.purge(UploadChunkInfo, before)
+            self.purge(UploadBatchInfo, before)
+
+        logger.info('maintenance finished in {:.1f}s'.format(time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='purge expired rows and orphan upload chunks')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be removed')
+    args = parser.parse_args()
+
+    Maintenance(dry_run=args.dry_run).run()
+    server_dao.replica_router.close()
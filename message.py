@@ -15,3 +15,4 @@ class MessageEnum(Message):
     BAD_REQUEST = ('10001', 'Bad Request', 400)
     UNAUTHORIZED = ('10002', 'Unauthorized', 401)
     INTERNAL_ERROR = ('10003', 'Internal Error', 500)
+    NOT_FOUND = ('10004', 'Not Found', 404)
@@ -0,0 +1,115 @@
+import hashlib
+import os
+import time
+import uuid
+
+
+class MultipartFileEncoder:
+    """
+    流式multipart/form-data请求体：普通字段在前，文件按固定大小分块从磁盘读取发送，整个请求体不会载入内存。
+    发送文件的同时计算md5，并统计发送的字节数和耗时。
+    作为requests的data参数使用，提供__len__以便requests设置Content-Length
+    """
+
+    def __init__(self, fields: dict, file_field: str, file_path: str, file_name: str = None,
+                 content_type: str = 'application/octet-stream', chunk_size: int = 1024 * 1024,
+                 extra_files: dict = None):
+        """
+        :param fields: 普通表单字段
+        :param file_field: 文件字段名
+        :param file_path: 文件路径
+        :param file_name: 请求中的文件名，默认取文件路径中的文件名
+        :param content_type: 文件的Content-Type
+        :param chunk_size: 每次读取发送的字节数
+        :param extra_files: 在主文件之后发送的其它文件{字段名: 文件路径}，不计入md5
+        """
+        self.boundary = uuid.uuid4().hex
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self.file_size = os.path.getsize(file_path)
+        self.file_content_type = content_type
+
+        head = []
+        for name, value in fields.items():
+            head.append('--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(
+                self.boundary, name, value))
+        head.append(self._file_header(file_field, file_name or os.path.basename(file_path)))
+        self._head = ''.join(head).encode('utf-8')
+        # 其它文件的分隔头和内容，[(分隔头, 文件路径, 文件大小), ...]
+        self._extra_files = [(''.join(['\r\n', self._file_header(name, os.path.basename(path))]).encode('utf-8'),
+                              path, os.path.getsize(path)) for name, path in (extra_files or {}).items()]
+        self._tail = '\r\n--{}--\r\n'.format(self.boundary).encode('utf-8')
+
+        self._md5 = hashlib.md5()
+        self._file = None
+        self.sent_bytes = 0
+        self.started_at = None
+        self.finished_at = None
+
+    def _file_header(self, field, file_name):
+        return '--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\nContent-Type: {}\r\n\r\n'.format(
+            self.boundary, field, file_name, self.file_content_type)
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary={}'.format(self.boundary)
+
+    def __len__(self):
+        return (len(self._head) + self.file_size + sum(len(header) + size for header, _, size in self._extra_files)
+                + len(self._tail))
+
+    def __iter__(self):
+        self.started_at = time.perf_counter()
+        self._file = open(self.file_path, 'rb')
+        try:
+            yield self._send(self._head)
+            while True:
+                data = self._file.read(self.chunk_size)
+                if not data:
+                    break
+                self._md5.update(data)
+                yield self._send(data)
+            for header, path, _ in self._extra_files:
+                yield self._send(header)
+                with open(path, 'rb') as f:
+                    while True:
+                        data = f.read(self.chunk_size)
+                        if not data:
+                            break
+                        yield self._send(data)
+            yield self._send(self._tail)
+            self.finished_at = time.perf_counter()
+        finally:
+            self.close()
+
+    def _send(self, data):
+        self.sent_bytes += len(data)
+        return data
+
+    def close(self):
+        if self._file is not None and not self._file.closed:
+            self._file.close()
+
+    @property
+    def md5(self):
+        """
+        文件内容的md5，文件全部发送后才有值
+        """
+        return self._md5.hexdigest() if self.finished_at is not None else None
+
+    @property
+    def elapsed(self):
+        """
+        发送耗时(秒)
+        """
+        if self.started_at is None:
+            return 0
+        return (self.finished_at or time.perf_counter()) - self.started_at
+
+    @property
+    def throughput(self):
+        """
+        发送速度(MB/s)
+        """
+        elapsed = self.elapsed
+        return self.sent_bytes / 1024 / 1024 / elapsed if elapsed > 0 else 0
@@ -0,0 +1,106 @@
+import re
+import time
+import zipfile
+from collections import namedtuple
+
+from lxml import etree
+
+from log_utils import logger
+
+PLUGIN_XML = 'META-INF/plugin.xml'
+# 插件zip包的结构为<插件目录>/lib/*.jar，plugin.xml在其中一个jar中
+NESTED_JAR_PATTERN = re.compile(r'^([^/]+)/lib/([^/]+\.jar)$')
+
+PluginDescriptor = namedtuple('PluginDescriptor', ['id', 'name', 'description', 'version', 'vendor_name',
+                                                   'vendor_email', 'vendor_url', 'change_notes', 'since_build',
+                                                   'until_build'])
+
+
+def _read_member(archive: zipfile.ZipFile, name: str):
+    try:
+        info = archive.getinfo(name)
+    except KeyError:
+        return None
+    return archive.read(info)
+
+
+def _nested_jars(archive: zipfile.ZipFile):
+    """
+    按可能包含plugin.xml的顺序返回lib目录下的jar：与插件目录同名的jar优先，其余按压缩后大小从小到大
+    """
+    candidates = []
+    for info in archive.infolist():
+        match = NESTED_JAR_PATTERN.match(info.filename)
+        if match:
+            candidates.append((not match.group(2).startswith(match.group(1)), info.compress_size, info.filename, info))
+    return [candidate[-1] for candidate in sorted(candidates, key=lambda candidate: candidate[:3])]
+
+
+def read_plugin_xml(archive_path: str):
+    """
+    从插件包中读取plugin.xml，只读取压缩包的中央目录和plugin.xml所在的条目，不解压整个文件。
+    jar包直接读取META-INF/plugin.xml；zip包依次打开lib目录下的jar，嵌套的jar以流的方式打开，不写临时文件
+    :param archive_path: 插件包路径(.zip/.jar)
+    :return: plugin.xml的内容，找不到时返回None
+    """
+    start = time.perf_counter()
+    opened = 0
+    content = None
+    with zipfile.ZipFile(archive_path) as archive:
+        content = _read_member(archive, PLUGIN_XML)
+        if content is None:
+            for info in _nested_jars(archive):
+                opened += 1
+                try:
+                    with archive.open(info) as nested_file, zipfile.ZipFile(nested_file) as nested:
+                        content = _read_member(nested, PLUGIN_XML)
+                except zipfile.BadZipFile:
+                    logger.warning('{} in {} is not a valid jar'.format(info.filename, archive_path))
+                    continue
+                if content is not None:
+                    break
+    logger.debug('read plugin.xml from {} in {:.1f} ms, {} nested jars opened, found: {}'.format(
+        archive_path, (time.perf_counter() - start) * 1000, opened, content is not None))
+    return content
+
+
+def _text(plugin, tag):
+    element = plugin.find(tag)
+    return element.text if element is not None else None
+
+
+def parse_plugin_xml(content: bytes):
+    """
+    解析plugin.xml
+    :return: PluginDescriptor
+    """
+    plugin = etree.fromstring(content, parser=etree.XMLParser(strip_cdata=False, resolve_entities=False))
+    plugin_id = _text(plugin, 'id')
+    version = _text(plugin, 'version')
+    if not plugin_id or not version:
+        raise ValueError('id and version are required in plugin.xml')
+
+    vendor = plugin.find('vendor')
+    vendor_attrib = vendor.attrib if vendor is not None else {}
+    idea_version = plugin.find('idea-version')
+    idea_version_attrib = idea_version.attrib if idea_version is not None else {}
+    return PluginDescriptor(id=plugin_id, name=_text(plugin, 'name'), description=_text(plugin, 'description'),
+                            version=version, vendor_name=vendor.text if vendor is not None else None,
+                            vendor_email=vendor_attrib.get('email'), vendor_url=vendor_attrib.get('url'),
+                            change_notes=_text(plugin, 'change-notes'),
+                            since_build=idea_version_attrib.get('since-build'),
+                            until_build=idea_version_attrib.get('until-build'))
+
+
+def inspect_archive(archive_path: str):
+    """
+    读取并解析插件包中的plugin.xml
+    :return: PluginDescriptor
+    """
+    try:
+        content = read_plugin_xml(archive_path)
+    except zipfile.BadZipFile:
+        raise RuntimeError('archive is not a valid zip or jar file')
+    if content is None:
+        raise RuntimeError('{} not found in archive'.format(PLUGIN_XML))
+    return parse_plugin_xml(content)
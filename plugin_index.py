@@ -0,0 +1,286 @@
+import bisect
+import datetime
+import re
+import threading
+import time
+from collections import namedtuple, defaultdict
+
+import server_dao
+from data_access import app_conf
+from ide_index import build_key, MIN_SEGMENT, MAX_SEGMENT
+from log_utils import logger
+
+PluginVersion = namedtuple('PluginVersion', ['version', 'since_build', 'until_build', 'rating', 'archive_size',
+                                             'release_time', 'tags', 'archive_suffix', 'product_codes'])
+# versions按版本号从高到低排序
+PluginDocument = namedtuple('PluginDocument', ['id', 'name', 'vendor_name', 'tags', 'versions'])
+
+# 各字段命中时的得分，完全匹配的词得分加倍
+FIELD_WEIGHTS = (('name', 4), ('id', 3), ('vendor_name', 2), ('tags', 1))
+# 驼峰、数字和分隔符都作为词的边界，如GitToolBox -> git, tool, box
+WORD_PATTERN = re.compile(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+')
+SEPARATOR_PATTERN = re.compile(r'[^0-9A-Za-z]+')
+
+
+def tokenize(text: str):
+    """
+    索引用的分词：按分隔符拆分的完整单词及其中按驼峰拆分的各部分，统一小写
+    """
+    if not text:
+        return set()
+    tokens = {word.lower() for word in WORD_PATTERN.findall(text)}
+    tokens.update(word.lower() for word in SEPARATOR_PATTERN.split(text) if word)
+    return tokens
+
+
+def tokenize_query(text: str):
+    """
+    查询用的分词：只按分隔符拆分，每个词按前缀匹配索引中的词
+    """
+    return [word.lower() for word in SEPARATOR_PATTERN.split(text or '') if word]
+
+
+class PluginIndex:
+    """
+    白名单插件的内存倒排索引，按插件名、ID、开发者和标签搜索，查询不访问数据库。
+    加载后由后台线程按catalog_entry的写入时间和白名单的更新时间查找变化的插件，只重新加载这些插件
+    """
+
+    def __init__(self, check_interval=10, lookback=60):
+        """
+        :param check_interval: 检查插件变化的间隔秒数
+        :param lookback: 查找变化时向前多查的秒数，覆盖提交较晚的事务和从库延迟
+        """
+        self.check_interval = check_interval
+        self.lookback = lookback
+
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._documents = {}
+        self._postings = defaultdict(dict)  # token -> {plugin_id: 得分}
+        self._tokens = []  # 有序的全部词，用于前缀查找
+        self._document_tokens = {}
+        self._stamps = {}  # (来源, plugin_id) -> 最近一次变化的时间
+        self._watermark = None
+        self._loaded = False
+
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def load(self):
+        """
+        全量加载索引
+        """
+        start = time.perf_counter()
+        # 先记录变化时间再读取数据，读取期间发生的变化会在下次检查时重新加载
+        stamps = self._load_stamps()
+        documents = self._load_documents()
+        with self._lock:
+            for plugin_id in list(self._documents):
+                self._remove(plugin_id)
+            for document in documents.values():
+                self._add(document)
+            self._stamps = stamps
+            self._watermark = max(stamps.values(), default=None)
+            self._loaded = True
+        logger.info('plugin index loaded {} plugins, {} tokens in {:.1f} ms'.format(
+            len(documents), len(self._tokens), (time.perf_counter() - start) * 1000))
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._load_lock:
+            if not self._loaded:
+                self.load()
+
+    @staticmethod
+    def _load_stamps(since=None):
+        stamps = {}
+        for source, query in (('catalog', server_dao.get_catalog_changes(since)),
+                              ('white_list', server_dao.get_white_list_changes(since))):
+            for row in query.namedtuples():
+                if row.changed_at is not None:
+                    stamps[(source, row[0])] = row.changed_at
+        return stamps
+
+    @staticmethod
+    def _load_documents(plugin_ids=None):
+        product_codes = defaultdict(set)
+        for row in server_dao.get_plugin_products(plugin_ids).namedtuples():
+            product_codes[(row.id, row.version)].add(row.product_code)
+
+        rows = defaultdict(list)
+        for row in server_dao.get_plugin_index_rows(plugin_ids).namedtuples():
+            rows[row.id].append(row)
+
+        documents = {}
+        for plugin_id, plugin_rows in rows.items():
+            versions = sorted((PluginVersion(row.version, row.since_build, row.until_build, row.rating,
+                                             row.archive_size, row.release_time, row.tags, row.archive_suffix,
+                                             frozenset(product_codes.get((plugin_id, row.version), ())))
+                               for row in plugin_rows), key=lambda version: build_key(version.version), reverse=True)
+            latest = next(row for row in plugin_rows if row.version == versions[0].version)
+            tags = sorted({tag.strip() for row in plugin_rows if row.tags for tag in row.tags.split(',') if tag.strip()})
+            documents[plugin_id] = PluginDocument(plugin_id, latest.name, latest.vendor_name, tags, versions)
+        return documents
+
+    def refresh_plugins(self, plugin_ids: list):
+        """
+        重新加载指定插件，不在白名单或已没有可下载版本的插件从索引中删除
+        """
+        if not plugin_ids or not self._loaded:
+            return
+        documents = self._load_documents(plugin_ids)
+        with self._lock:
+            for plugin_id in plugin_ids:
+                self._remove(plugin_id)
+                if plugin_id in documents:
+                    self._add(documents[plugin_id])
+        logger.debug('plugin index refreshed {} plugins'.format(len(plugin_ids)))
+
+    def check_changes(self):
+        """
+        查找上次检查之后有变化的插件并重新加载
+        :return: 重新加载的插件数
+        """
+        if not self._loaded:
+            self._ensure_loaded()
+            return 0
+
+        since = self._watermark - datetime.timedelta(seconds=self.lookback) if self._watermark else None
+        stamps = self._load_stamps(since)
+        changed = {key for key, changed_at in stamps.items() if self._stamps.get(key) != changed_at}
+        if not changed:
+            return 0
+
+        self.refresh_plugins(sorted({plugin_id for _, plugin_id in changed}))
+        with self._lock:
+            self._stamps.update(stamps)
+            self._watermark = max(stamps.values()) if self._watermark is None else max(self._watermark,
+                                                                                       *stamps.values())
+        return len(changed)
+
+    def _add(self, document):
+        scores = {}
+        for field, weight in FIELD_WEIGHTS:
+            value = getattr(document, field)
+            for token in tokenize(' '.join(value) if isinstance(value, list) else value):
+                scores[token] = max(scores.get(token, 0), weight)
+        for token, score in scores.items():
+            if token not in self._postings:
+                bisect.insort(self._tokens, token)
+            self._postings[token][document.id] = score
+        self._documents[document.id] = document
+        self._document_tokens[document.id] = list(scores)
+
+    def _remove(self, plugin_id):
+        self._documents.pop(plugin_id, None)
+        for token in self._document_tokens.pop(plugin_id, ()):
+            postings = self._postings[token]
+            postings.pop(plugin_id, None)
+            if not postings:
+                del self._postings[token]
+                del self._tokens[bisect.bisect_left(self._tokens, token)]
+
+    def _match(self, query_tokens):
+        """
+        :return: {plugin_id: 得分}，每个查询词都要按前缀命中
+        """
+        if not query_tokens:
+            return {plugin_id: 0 for plugin_id in self._documents}
+
+        scores = None
+        for query_token in query_tokens:
+            matched = {}
+            low = bisect.bisect_left(self._tokens, query_token)
+            high = bisect.bisect_left(self._tokens, query_token + MAX_SEGMENT)
+            for token in self._tokens[low:high]:
+                for plugin_id, weight in self._postings[token].items():
+                    score = weight * 2 if token == query_token else weight
+                    if score > matched.get(plugin_id, 0):
+                        matched[plugin_id] = score
+            if scores is None:
+                scores = matched
+            else:
+                scores = {plugin_id: scores[plugin_id] + score for plugin_id, score in matched.items()
+                          if plugin_id in scores}
+            if not scores:
+                break
+        return scores
+
+    @staticmethod
+    def compatible_versions(document, product_code: str = None, build: str = None):
+        """
+        插件中兼容指定产品和IDE构建版本的版本，按版本号从高到低
+        """
+        key = build_key(build) if build else None
+        for version in document.versions:
+            if product_code and product_code not in version.product_codes:
+                continue
+            if key is not None:
+                if version.since_build and build_key(version.since_build, MIN_SEGMENT) > key:
+                    continue
+                if version.until_build and build_key(version.until_build, MAX_SEGMENT) < key:
+                    continue
+            yield version
+
+    def search(self, query: str = None, product_code: str = None, build: str = None, page: int = 1,
+               page_size: int = 20):
+        """
+        搜索插件，结果按得分从高到低、插件名排序
+        :param query: 查询词，为空时返回全部插件
+        :param product_code: 只返回该产品的目录中有的插件
+        :param build: 只返回兼容该IDE构建版本的插件
+        :return: (命中总数, [(PluginDocument, 兼容的最新PluginVersion), ...])
+        """
+        self._ensure_loaded()
+        with self._lock:
+            scores = self._match(tokenize_query(query))
+            results = []
+            for plugin_id, score in scores.items():
+                document = self._documents[plugin_id]
+                version = next(self.compatible_versions(document, product_code, build), None)
+                if version is not None:
+                    results.append((score, document, version))
+        results.sort(key=lambda result: (-result[0], (result[1].name or '').lower(), result[1].id))
+        offset = (page - 1) * page_size
+        return len(results), [(document, version) for _, document, version in results[offset:offset + page_size]]
+
+    def get(self, plugin_id: str):
+        self._ensure_loaded()
+        with self._lock:
+            return self._documents.get(plugin_id)
+
+    def start(self):
+        if self._thread is not None or self.check_interval <= 0:
+            return
+        self._thread = threading.Thread(target=self._run, name='plugin-index', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                changed = self.check_changes()
+                if changed:
+                    logger.info('plugin index reloaded {} changed plugins'.format(changed))
+            except Exception as e:
+                logger.exception('plugin index refresh failed', e)
+            finally:
+                server_dao.replica_router.close()
+            self._stopped.wait(self.check_interval)
+
+    def stats(self):
+        with self._lock:
+            return {'plugins': len(self._documents), 'tokens': len(self._tokens),
+                    'versions': sum(len(document.versions) for document in self._documents.values()),
+                    'watermark': str(self._watermark) if self._watermark else None}
+
+
+plugin_index = PluginIndex(check_interval=app_conf.get('plugin_index', {}).get('check_interval', 10),
+                           lookback=app_conf.get('plugin_index', {}).get('lookback', 60))
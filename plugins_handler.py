@@ -1,7 +1,7 @@
 import os
 import re
 import shutil
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
 
@@ -18,7 +18,10 @@ from log_utils import logger
 
 class PluginsHandler:
 
-    def __init__(self):
+    def __init__(self, app_conf: dict = None):
+        """
+        :param app_conf: 已加载的配置，为空时读取application.yaml
+        """
         app_dir = os.path.split(os.path.realpath(__file__))[0]
         self.work_dir = app_dir
         # self.plugins_db = ''.join([os.path.dirname(__file__), '/', 'plugins.db'])
@@ -27,8 +30,9 @@ class PluginsHandler:
         self.proxies = None
         # self.logger = logger
 
-        with open(''.join([app_dir, '/', 'application.yaml']), 'r') as f:
-            app_conf = yaml.safe_load(f)
+        if app_conf is None:
+            with open(''.join([app_dir, '/', 'application.yaml']), 'r') as f:
+                app_conf = yaml.safe_load(f)
 
         self.jetbrains_plugins_site = app_conf['jetbrains_plugins_site']
         self.repo_url = app_conf['repo_url']
@@ -36,6 +40,9 @@ class PluginsHandler:
         self.intellij_public = app_conf['nexus']['intellij_public']
         self.intellij_releases = app_conf['nexus']['intellij_releases']
         self.user_agent = app_conf['user_agent']
+        self.suffix_workers = app_conf['sync']['suffix_workers']
+        self.download_workers = app_conf['sync']['download_workers']
+        self.catalog_layout = app_conf['catalog']['layout']
         if app_conf['work_dir']:
             self.work_dir = app_conf['work_dir']
 
@@ -78,6 +85,7 @@ class PluginsHandler:
         plugins_list = ''.join([self.work_dir, '/plugins_list_', idea_version, '.xml'])
         tree = etree.parse(plugins_list, etree.XMLParser(strip_cdata=False, resolve_entities=False))
         root = tree.getroot()
+        plugin_versions = []
         for node_idea_plugin in root.iter('idea-plugin'):
             node_name_text = node_idea_plugin.find('name').text
             node_id_text = node_idea_plugin.find('id').text
@@ -126,14 +134,10 @@ class PluginsHandler:
                                                    attr_archive_size, datetime.fromtimestamp(int(attr_release_time)/1000),
                                                    tags_content, vendor_id)
 
-            server_dao.move_old_support_version(node_id_text, re.sub(r'(%s=[-+]).*', '', node_version_text),
-                                                [(product_code, build_version)])
-
-            server_dao.remove_old_ide_support_version(node_id_text,
-                                                      re.sub(r'(%s=[-+]).*', '', node_version_text),
-                                                      product_code, build_version)
+            plugin_versions.append((node_id_text, node_version_text, re.sub(r'(%s=[-+]).*', '', node_version_text)))
 
-            server_dao.add_new_support_version([(node_id_text, node_version_text, product_code, build_version)])
+        # 整个IDE版本一次性轮换支持的插件版本
+        server_dao.rotate_support_versions(product_code, build_version, plugin_versions)
 
     def generate_update_plugins_xml(self, product_code, build_version, is_download=False):
         """
@@ -144,25 +148,36 @@ class PluginsHandler:
 
         query_result = server_dao.get_latest_plugins_by_ide(product_code, build_version)
         if is_download:
-            for row in query_result.namedtuples().iterator():
-                logger.debug('name = {}, id = {}'.format(row.name, row.id))
-
-                download_info = server_dao.get_download_info(row.id, row.version)
-                if download_info:
-                    logger.info('[{}][{}] has been downloaded, skip'.format(row.id, row.version))
-                    self.generate_node_info(download_info.archive_name, root, row, mode='local')
-                    continue
-
-                logger.info('begin to download [{}][{}]'.format(row.id, row.version))
-                plugin_archive_name, file_md5sum = self.download_plugin(row.id, row.version)
-                # 下载成功再写入xml文件
+            rows = list(server_dao.iterate_rows(query_result, label='get_latest_plugins_by_ide'))
+
+            # 一次查出该IDE版本下所有插件的下载信息，避免逐个插件查询
+            downloaded = {(info.id, info.version): info.archive_name
+                          for info in server_dao.get_download_info_by_ide(product_code, build_version)
+                          .namedtuples().iterator()}
+            missing_rows = [row for row in rows if (row.id, row.version) not in downloaded]
+            logger.info('[{}-{}] {} plugins downloaded, {} to download'.format(
+                product_code, build_version, len(rows) - len(missing_rows), len(missing_rows)))
+
+            new_download_info = []
+            with ThreadPoolExecutor(max_workers=self.download_workers) as p:
+                future_rows = {p.submit(self.download_plugin, row.id, row.version): row for row in missing_rows}
+                for future in as_completed(future_rows):
+                    row = future_rows[future]
+                    plugin_archive_name, file_md5sum = future.result()
+                    if plugin_archive_name:
+                        logger.info('download [{}][{}] finished'.format(row.id, row.version))
+                        downloaded[(row.id, row.version)] = plugin_archive_name
+                        new_download_info.append((row.id, row.version, plugin_archive_name, file_md5sum))
+
+            server_dao.add_download_infos(new_download_info)
+
+            # 下载成功再写入xml文件
+            for row in rows:
+                plugin_archive_name = downloaded.get((row.id, row.version))
                 if plugin_archive_name:
-                    logger.info('download [{}][{}] finished, save info'.format(row.id, row.version))
-                    server_dao.add_new_download_info(row.id, row.version, plugin_archive_name, file_md5sum)
-
                     self.generate_node_info(plugin_archive_name, root, row, mode='local')
         else:
-            for row in query_result.namedtuples().iterator():
+            for row in server_dao.iterate_rows(query_result, label='get_latest_plugins_by_ide'):
                 self.generate_node_info(row.name, root, row)
 
         self.write_xml(product_code, build_version, root)
@@ -176,6 +191,17 @@ class PluginsHandler:
         # with open(update_plugins_xml, mode='wb') as f:
         #     f.write(etree.tostring(root, pretty_print=True, xml_declaration=True, encoding='utf-8'))
 
+    def render_update_plugins_xml(self, product_code, build_version):
+        """
+        实时生成指定IDE版本的updatePlugins.xml内容，不落盘
+        :return: xml字节串
+        """
+        root = etree.Element('plugins')
+        query_result = server_dao.get_latest_plugins_by_ide(product_code, build_version)
+        for row in server_dao.iterate_rows(query_result, label='get_latest_plugins_by_ide'):
+            self.generate_node_info(row.name, root, row)
+        return self.to_xml_bytes(root)
+
     @deprecated
     def download_plugin(self, plugin_id, version):
         """
@@ -289,41 +315,70 @@ class PluginsHandler:
         }
         payload = {'pluginId': plugin_xml_id, 'version': version}
         response = requests.head(''.join([self.jetbrains_plugins_site, 'plugin/download']),
-                                 headers=headers, params=payload, proxies=self.proxies)
+                                 headers=headers, params=payload, proxies=self.proxies, timeout=dl.DEFAULT_TIMEOUT)
         if response.status_code in (301, 302):
             pattern = re.compile(r'\.(?<=\.)[^.]*(?=\?)')
             return pattern.search(response.headers['Location']).group()
         else:
             return None
 
+    def resolve_plugin_file_suffixes(self):
+        """
+        并发查询缺少后缀名的插件包后缀，结果一次性批量写回download_info。
+        download_info.archive_suffix即(id, version)到后缀名的持久化缓存，已有后缀的插件不会再次请求
+        :return: None
+        """
+        plugins_without_suffix = list(server_dao.query_plugins_without_suffix().namedtuples().iterator())
+        if not plugins_without_suffix:
+            return
+
+        resolved = []
+        with ThreadPoolExecutor(max_workers=self.suffix_workers) as p:
+            future_rows = {p.submit(self.get_plugin_file_suffix, row.id, row.version): row
+                           for row in plugins_without_suffix}
+            for future in as_completed(future_rows):
+                row = future_rows[future]
+                try:
+                    suffix = future.result()
+                except Exception as e:
+                    logger.exception('check plugin suffix failed', e)
+                    continue
+
+                if not suffix:
+                    logger.warning('[{}][{}] plugin file suffix not found'.format(row.id, row.version))
+                    continue
+                resolved.append((row.id, row.version, ''.join([row.id, '-', row.version, suffix]), suffix))
+
+        server_dao.save_plugin_file_suffixes(resolved)
+        logger.info('resolved {} of {} plugin file suffixes'.format(len(resolved), len(plugins_without_suffix)))
+
     def generate_all_update_plugins_xml(self):
         # 检查每个待同步的插件是否已经知道其后缀名(archive_suffix是新增字段，历史数据没有值，需要对历史数据做处理)
-        plugins_without_suffix = server_dao.query_plugins_without_suffix()
-        for row in plugins_without_suffix.namedtuples().iterator():
-            try:
-                suffix = self.get_plugin_file_suffix(row.id, row.version)
-
-                if not row.plugin_id:  # row.plugin_id为download_info.id字段，为空表示该表没有此记录
-                    server_dao.add_new_download_info(row.id, row.version,
-                                                     ''.join([row.id, '-', row.version, suffix]), suffix)
-                else:
-                    server_dao.update_plugin_file_suffix(row.id, row.version, suffix)
-            except Exception as e:
-                logger.exception('check plugin suffix failed', e)
+        self.resolve_plugin_file_suffixes()
 
+        if self.catalog_layout == 'per_build':
+            self.generate_per_build_update_plugins_xml()
+        else:
+            self.generate_consolidated_update_plugins_xml()
+
+    def generate_per_build_update_plugins_xml(self):
+        """
+        按IDE版本输出updatePlugins-<code>-<build>.xml
+        :return: None
+        """
         # 按IDE版本排序获取其可用的插件
         plugins_for_xml = server_dao.query_plugins_for_update_xml()
         root = etree.Element('plugins')
         last_product_code = None
         last_build_version = None
 
-        for row in plugins_for_xml.namedtuples().iterator():
+        for row in server_dao.iterate_rows(plugins_for_xml, label='query_plugins_for_update_xml'):
             if not last_product_code:
                 last_product_code = row.product_code
             if not last_build_version:
                 last_build_version = row.build_version
 
-            if last_build_version != row.build_version:
+            if last_product_code != row.product_code or last_build_version != row.build_version:
                 self.write_xml(last_product_code, last_build_version, root)
                 root = etree.Element('plugins')
 
@@ -335,15 +390,76 @@ class PluginsHandler:
         if last_product_code and last_build_version:
             self.write_xml(last_product_code, last_build_version, root)
 
+    def generate_consolidated_update_plugins_xml(self, product_code=None):
+        """
+        输出去重后的目录文件，每个(插件, 版本)只出现一次，由IDE根据since-build/until-build自行过滤。
+        per_product模式下每个产品一个updatePlugins-<code>.xml，all模式下所有产品共用一个updatePlugins.xml
+        :param product_code: per_product模式下只重新生成该产品的目录，为空则生成全部
+        :return: None
+        """
+        if self.catalog_layout == 'all':
+            product_code = None
+
+        plugins_for_xml = server_dao.query_plugins_for_update_xml(product_code)
+        roots = {}
+        written_plugins = {}
+        node_sizes = {}
+        builds = set()
+        per_build_size = 0
+
+        for row in server_dao.iterate_rows(plugins_for_xml, label='query_plugins_for_update_xml'):
+            catalog_name = row.product_code if self.catalog_layout == 'per_product' else None
+            plugin_key = (row.id, row.version)
+            builds.add((row.product_code, row.build_version))
+
+            if catalog_name not in roots:
+                roots[catalog_name] = etree.Element('plugins')
+                written_plugins[catalog_name] = set()
+
+            if plugin_key not in written_plugins[catalog_name]:
+                written_plugins[catalog_name].add(plugin_key)
+                self.generate_node_info(row.name, roots[catalog_name], row)
+                if plugin_key not in node_sizes:
+                    node_sizes[plugin_key] = len(etree.tostring(roots[catalog_name][-1], pretty_print=True,
+                                                                encoding='utf-8'))
+
+            # 按IDE版本输出时，每个IDE版本都要重复一次该插件节点
+            per_build_size += node_sizes[plugin_key]
+
+        consolidated_size = 0
+        for catalog_name, root in roots.items():
+            file_name = 'updatePlugins.xml' if catalog_name is None else ''.join(['updatePlugins-', catalog_name,
+                                                                                  '.xml'])
+            consolidated_size += self.write_catalog_xml(file_name, root)
+
+        per_build_size += len(self.to_xml_bytes(etree.Element('plugins'))) * len(builds)
+        if per_build_size:
+            logger.info('consolidated catalog: {} files, {} bytes; per-build layout: {} files, ~{} bytes '
+                        '({:.1f}% smaller)'.format(len(roots), consolidated_size, len(builds), per_build_size,
+                                                   (1 - consolidated_size / per_build_size) * 100))
+
     def write_xml(self, product_code, build_version, root_node):
+        self.write_catalog_xml(''.join(['updatePlugins', '-', product_code, '-', build_version, '.xml']), root_node)
+
+    def write_catalog_xml(self, file_name, root_node):
+        """
+        将目录写入插件目录下的指定文件
+        :param file_name: 文件名
+        :param root_node: xml根节点
+        :return: 写入的字节数
+        """
         plugins_dir = Path(self.plugins_store_dir)
 
         if not plugins_dir.exists():
             plugins_dir.mkdir(parents=True, exist_ok=True)
-        update_plugins_xml = ''.join([self.plugins_store_dir, 'updatePlugins', '-',
-                                      product_code, '-', build_version, '.xml'])
-        with open(update_plugins_xml, mode='wb') as f:
-            f.write(etree.tostring(root_node, pretty_print=True, xml_declaration=True, encoding='utf-8'))
+        content = self.to_xml_bytes(root_node)
+        with open(''.join([self.plugins_store_dir, file_name]), mode='wb') as f:
+            f.write(content)
+        return len(content)
+
+    @staticmethod
+    def to_xml_bytes(root_node):
+        return etree.tostring(root_node, pretty_print=True, xml_declaration=True, encoding='utf-8')
 
     def download_plugin_archive(self, day_offset: int = 0):
         plugins_info = server_dao.get_recent_released_plugins(day_offset)
@@ -1,10 +1,14 @@
 from plugins_handler import PluginsHandler
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from data_access import app_conf, replica_router
+from db_metrics import query_metrics
+from dbpool import db_pool
 from log_utils import logger
 
 
 def main_process(thread_count=5):
     handler = PluginsHandler()
+    query_metrics.reset()
 
     logger.info('===== start to update plugins =====')
     ides = handler.get_ide_versions()
@@ -14,6 +18,8 @@ def main_process(thread_count=5):
             futures.append(p.submit(get_plugins_list, handler, ide.product_code, ide.version, ide.build_version))
         as_completed(futures)
 
+    # 从库追上主库后再生成xml，超时仍落后的从库会被跳过
+    replica_router.wait_for_replicas()
     logger.info('+++++ generate update plugins xml begin +++++')
     handler.generate_all_update_plugins_xml()
     logger.info('+++++ generate update plugins xml end +++++')
@@ -22,6 +28,10 @@ def main_process(thread_count=5):
     handler.download_plugin_archive(day_offset=0)
     logger.info('+++++ download plugins to nexus end +++++')
 
+    replica_router.close()
+    logger.info('database pool stats: {}'.format(db_pool.stats()))
+    logger.info('replica routing stats: {}'.format(replica_router.stats()))
+    query_metrics.log_summary(app_conf['peewee']['metrics_top_n'])
     logger.info('===== job finished =====')
 
 
@@ -37,6 +47,9 @@ def get_plugins_list(handler: PluginsHandler, product_code: str, version: str, b
     except Exception as e:
         handler.update_sync_status(product_code, build_version, '0')
         logger.exception('something went wrong during the update progress', e)
+    finally:
+        # 工作线程结束前归还连接，避免线程私有的连接一直占用连接池
+        replica_router.close()
     logger.info(
         '===== update [{} {} (Release Version: {})] plugin list end ====='.format(product_code, version, build_version))
 
@@ -1,10 +1,15 @@
+import datetime
+import json
 import os
 import time
+from pathlib import Path
 
 import requests
 import yaml
 
 import server_dao
+from ide_index import ide_index
+from log_utils import logger
 
 
 class Manager:
@@ -17,6 +22,7 @@ class Manager:
         self.support_product_codes = app_conf['support_product_codes']
         self.support_earliest_build_version = app_conf['support_earliest_build_version']
         self.user_agent = app_conf['user_agent']
+        self.state_file = ''.join([app_conf['work_dir'], '/products_state.json'])
 
         self.proxies = {}
         proxy_conf = app_conf['proxy']
@@ -25,42 +31,87 @@ class Manager:
                                  'http': proxy_conf['address']
                                  })
 
+    def load_state(self):
+        """
+        上次拉取产品列表时服务端返回的ETag和Last-Modified
+        """
+        try:
+            with open(self.state_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_state(self, response):
+        state = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+        Path(self.state_file).parent.mkdir(parents=True, exist_ok=True)
+        with open(self.state_file, 'w') as f:
+            json.dump(state, f)
+
     def check_updates(self):
+        start = time.perf_counter()
         headers = {'User-Agent': self.user_agent}
+        state = self.load_state()
+        if state.get('etag'):
+            headers['If-None-Match'] = state['etag']
+        if state.get('last_modified'):
+            headers['If-Modified-Since'] = state['last_modified']
         payload = {
             'code': self.support_product_codes,
-            'release.type': 'release',
-            '_': int(round(time.time() * 1000))
+            'release.type': 'release'
         }
 
         response = requests.get(''.join([self.jetbrains_data_services, 'products']),
-                                headers=headers, params=payload, stream=True, proxies=self.proxies)
+                                headers=headers, params=payload, proxies=self.proxies)
+        if response.status_code == 304:
+            logger.info('products not modified, check finished in {:.1f}s'.format(time.perf_counter() - start))
+            return
+        response.raise_for_status()
         resp_json = response.json()
 
+        # 只写入库中还没有的IDE版本
+        ide_index.refresh()
+        known_builds = {(build.product_code, build.build_version) for build in ide_index.builds_between()}
+        new_builds = {}
+        release_count = 0
         for item in resp_json:
-            releases = item['releases']
-            for rel in releases:
+            product_code = item['intellijProductCode']
+            for rel in item['releases']:
                 build_version = rel['build']
-                product_code = item['intellijProductCode']
-                version = rel['version']
-                if build_version[:build_version.find('.')] >= self.support_earliest_build_version:
-                    server_dao.update_ide_versions(product_code, build_version, version)
-
-        # 检查自定义插件是否支持新增的IDE版本
-        plugin_support_ide_info = server_dao.check_internal_plugin_support_ide_version()
-        last_row = None
+                release_count += 1
+                if (build_version[:build_version.find('.')] >= self.support_earliest_build_version
+                        and (product_code, build_version) not in known_builds):
+                    new_builds[(product_code, build_version)] = rel['version']
+
+        server_dao.add_ide_versions([(product_code, build_version, version)
+                                     for (product_code, build_version), version in new_builds.items()])
+
+        # 新增的IDE版本立即加入索引
+        if new_builds:
+            ide_index.refresh()
+
+        # 检查自定义插件是否支持近5天新增的IDE版本，每个插件在每个IDE版本下取最新创建的版本
+        created_after = datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days=5),
+                                                  datetime.time.min)
         update_list = []
-        i = 0
-        for row in plugin_support_ide_info.namedtuples().iterator():
-            if ((i == 0)
-                    or (last_row is not None
-                        and (last_row.id != row.id or last_row.build_version != row.build_version))):
-                update_list.append((row.id, row.plugin_version, row.product_code, row.build_version))
+        matched = set()
+        for row in server_dao.iterate_rows(server_dao.get_internal_plugin_versions(),
+                                           label='get_internal_plugin_versions'):
+            if not row.since_build:
+                continue
+            for build in ide_index.builds_between(row.since_build, row.until_build, created_after=created_after):
+                key = (row.id, build.product_code, build.build_version)
+                if key not in matched:
+                    matched.add(key)
+                    update_list.append((row.id, row.version, build.product_code, build.build_version))
 
-            last_row = row
-            i += 1
+        if update_list:
+            server_dao.add_new_support_version(update_list)
+            server_dao.refresh_catalog_entries(plugin_ids=[plugin_id for plugin_id, _, _, _ in update_list])
 
-        server_dao.add_new_support_version(update_list)
+        # 全部写入成功后再记录，失败时下次重新拉取
+        self.save_state(response)
+        logger.info('{} releases checked, {} new builds, {} internal plugin support versions added in {:.1f}s'.format(
+            release_count, len(new_builds), len(update_list), time.perf_counter() - start))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,96 @@
+import argparse
+
+from data_access import app_conf
+from log_utils import logger
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    # gunicorn不支持Windows，未安装时回退到Werkzeug多线程服务
+    BaseApplication = object
+
+
+def gunicorn_options(conf: dict):
+    """
+    将application.yaml中server的配置转换为gunicorn的配置
+    """
+    worker_class = conf['worker_class']
+    options = {
+        'bind': conf['bind'],
+        'workers': conf['workers'],
+        'worker_class': worker_class,
+        'timeout': conf['timeout'],
+        'graceful_timeout': conf['graceful_timeout'],
+        'keepalive': conf['keepalive'],
+        'max_requests': conf['max_requests'],
+        'max_requests_jitter': conf['max_requests'] // 10,
+        # 预加载时在主进程中导入server，工作进程共享导入后的代码和只读配置
+        'preload_app': conf['preload'],
+        'post_worker_init': post_worker_init,
+        'worker_exit': worker_exit,
+    }
+    if worker_class == 'gthread':
+        options['threads'] = conf['threads']
+    elif worker_class == 'gevent':
+        options['worker_connections'] = conf['worker_connections']
+        # gevent在工作进程启动时才替换标准库的阻塞调用，主进程中预先导入的模块创建的锁和连接不会被替换
+        if conf['preload']:
+            logger.warning('preload is disabled for the gevent worker')
+            options['preload_app'] = False
+    return options
+
+
+def post_worker_init(worker):
+    import server
+    server.start_background_workers()
+
+
+def worker_exit(arbiter, worker):
+    import server
+    server.stop_background_workers(timeout=arbiter.cfg.graceful_timeout)
+    server.server_dao.replica_router.close()
+
+
+class PluginsServer(BaseApplication):
+
+    def __init__(self, options: dict):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from server import app
+        return app
+
+
+def run_werkzeug(conf: dict):
+    from werkzeug.serving import run_simple
+    import server
+
+    host, port = conf['bind'].rsplit(':', 1)
+    server.start_background_workers()
+    run_simple(host, int(port), server.app, threaded=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='run the plugin server')
+    parser.add_argument('--bind', help='override server.bind, e.g. 0.0.0.0:8080')
+    parser.add_argument('--workers', type=int, help='override server.workers')
+    parser.add_argument('--worker-class', choices=['sync', 'gthread', 'gevent'], help='override server.worker_class')
+    args = parser.parse_args()
+
+    server_conf = dict(app_conf['server'])
+    for key in ('bind', 'workers', 'worker_class'):
+        if getattr(args, key) is not None:
+            server_conf[key] = getattr(args, key)
+
+    if BaseApplication is object:
+        logger.warning('gunicorn is not installed, falling back to the threaded werkzeug server')
+        run_werkzeug(server_conf)
+    else:
+        logger.info('starting {} {} workers on {}'.format(server_conf['workers'], server_conf['worker_class'],
+                                                          server_conf['bind']))
+        PluginsServer(gunicorn_options(server_conf)).run()
@@ -1,24 +1,68 @@
 import collections
 import datetime
+import gzip
 import os
 import shutil
+import threading
+import time
 from pathlib import Path
 from typing import Any
 
 import requests
 import requests_mock
-from flask import request, jsonify
-from lxml import etree
+from flask import request, jsonify, make_response
 from werkzeug.utils import secure_filename
 
+import blockmap
 import common_utils
 import factory
+from catalog_cache import CatalogCache
+from ide_index import ide_index, build_key
+from job_queue import JobQueue
+from multipart_encoder import MultipartFileEncoder
+from ttl_cache import TTLCache
+import plugin_archive
+from plugin_index import plugin_index
 import plugins_handler
 import server_dao
 from log_utils import logger
 from message import MessageEnum
 
 app = factory.create_app()
+PluginInfo = collections.namedtuple('PluginInfo', ['plugin_id', 'plugin_version', 'archive_name', 'archive_suffix',
+                                                   'since_build', 'until_build'])
+# 各请求和后台任务共用，PluginsHandler只读配置，可以在线程间共享
+handler = plugins_handler.PluginsHandler(app.config)
+catalog_cache = CatalogCache(max_entries=app.config['catalog_cache']['max_entries'],
+                             compress_level=app.config['catalog_cache']['compress_level'])
+# 分片上传的每个请求都要校验票据，票据、Gitee用户和开发者身份的校验结果缓存一段时间
+auth_cache_conf = app.config['auth_cache']
+ticket_cache = TTLCache(max_entries=auth_cache_conf['max_entries'], ttl=auth_cache_conf['ticket_ttl'])
+user_cache = TTLCache(max_entries=auth_cache_conf['max_entries'], ttl=auth_cache_conf['user_ttl'])
+developer_cache = TTLCache(max_entries=auth_cache_conf['max_entries'], ttl=auth_cache_conf['developer_ttl'])
+CachedTicket = collections.namedtuple('CachedTicket', ['access_token', 'user_name', 'create_time'])
+# 插件包中plugin.xml的解析结果，按插件包的md5缓存
+descriptor_cache = TTLCache(max_entries=app.config['descriptor_cache']['max_entries'],
+                            ttl=app.config['descriptor_cache']['ttl'])
+
+
+def invalidate_catalog_cache(ide_info):
+    """
+    catalog_entry变化后立即释放本进程中旧的目录文档，其它进程按catalog_generation的变化重新生成
+    """
+    if ide_info is None:
+        catalog_cache.clear()
+        return
+    for product_code, build_version in ide_info:
+        catalog_cache.invalidate(product_code, build_version)
+
+
+server_dao.catalog_change_listeners.append(invalidate_catalog_cache)
+
+
+@app.teardown_request
+def release_db_connection(exc):
+    server_dao.replica_router.close()
 
 
 def to_web_msg(message_enum=MessageEnum.UNAUTHORIZED, biz_content: Any = None, hint: str = None):
@@ -30,6 +74,36 @@ def to_web_msg(message_enum=MessageEnum.UNAUTHORIZED, biz_content: Any = None, h
     return jsonify(ret_json), message_enum.status_code
 
 
+@app.route('/api/plugins/<product_code>/<build_version>/updatePlugins.xml', methods=['GET'])
+def get_update_plugins_xml(product_code, build_version):
+    ide_version = server_dao.get_ide_version(product_code, build_version)
+    if ide_version is None:
+        return to_web_msg(MessageEnum.NOT_FOUND, hint='Unknown IDE version')
+
+    # 同步任务和上传插件都会增加catalog_generation，时间字段只精确到秒，同一秒内的两次变化无法区分
+    generation = ide_version.catalog_generation
+    # 缓存按主库上的generation区分，内容也必须从主库读取，否则从库延迟时旧内容会以新版本号缓存
+    with server_dao.replica_router.primary_reads():
+        document = catalog_cache.get(product_code, build_version, generation,
+                                     lambda: handler.render_update_plugins_xml(product_code, build_version))
+
+    gzip_accepted = request.accept_encodings['gzip'] > 0
+    etag = ''.join([document.etag, '-gzip']) if gzip_accepted else document.etag
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    elif gzip_accepted:
+        response = make_response(document.gzip_body)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = make_response(gzip.decompress(document.gzip_body))
+
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.mimetype = 'application/xml'
+    return response
+
+
 @app.route('/api/plugins/upload', methods=['POST'])
 def upload():
     try:
@@ -37,22 +111,17 @@ def upload():
         if not access_token:
             return to_web_msg(hint='param access_token is required')
 
-        gitee_api = app.config['gitee_api']
-        with requests_mock.Mocker() as m:
-            m.get(''.join([gitee_api, '/user']), json={'login': 'JetBrains'}, status_code=200)
-            auth_check_resp = requests.get(''.join([gitee_api, '/user']), params={'access_token': access_token})
-        if auth_check_resp.status_code == 200:
-            user_info = auth_check_resp.json()
-            login = user_info['login']
+        login, reason = get_gitee_login(access_token)
+        if reason is None:
             if login:
                 check_developer(login)
-                handle_plugin_xml(login)
-                return to_web_msg(MessageEnum.SUCCESS)
+                job_id = handle_plugin_xml(login)
+                return to_web_msg(MessageEnum.SUCCESS, biz_content={'job_id': job_id})
             else:
                 return to_web_msg(MessageEnum.UNAUTHORIZED)
 
         else:
-            return to_web_msg(hint=auth_check_resp.reason)
+            return to_web_msg(hint=reason)
 
     except RuntimeError as e:
         return to_web_msg(MessageEnum.BAD_REQUEST, hint=str(e))
@@ -68,14 +137,8 @@ def get_tmp_ticket():
     if not access_token:
         return to_web_msg(MessageEnum.UNAUTHORIZED)
 
-    gitee_api = app.config['gitee_api']
-    with requests_mock.Mocker() as m:
-        m.get(''.join([gitee_api, '/user']), json={'login': 'JetBrains'}, status_code=200)
-        auth_check_resp = requests.get(''.join([gitee_api, '/user']), params={'access_token': access_token})
-    status_code = auth_check_resp.status_code
-    if status_code == 200:
-        user_info = auth_check_resp.json()
-        login = user_info['login']
+    login, reason = get_gitee_login(access_token)
+    if reason is None:
         if login:
             try:
                 check_developer(login)
@@ -95,7 +158,7 @@ def get_tmp_ticket():
         else:
             return to_web_msg()
     else:
-        return to_web_msg(hint=auth_check_resp.reason)
+        return to_web_msg(hint=reason)
 
 
 @app.route('/api/plugins/spec/check', methods=['POST'])
@@ -107,17 +170,18 @@ def check_plugin_xml():
     if not vt_result:
         return to_web_msg()
 
-    plugin_xml = request.files['plugin_xml']
+    # 分片上传前插件包还不在服务端，先按客户端提供的plugin.xml登记，合并后再以插件包中的plugin.xml校验
+    plugin_xml = request.files.get('plugin_xml')
     if plugin_xml:
         try:
-            plugin = etree.fromstring(plugin_xml.read(), parser=etree.XMLParser(strip_cdata=False, resolve_entities=False))
-            p_id = plugin.find('id').text
+            descriptor = plugin_archive.parse_plugin_xml(plugin_xml.read())
+            p_id = descriptor.id
 
             crp = server_dao.check_register_plugin(p_id)
             if crp is None:
                 return to_web_msg(hint='Unregistered plugin')
 
-            p_version = plugin.find('version').text
+            p_version = descriptor.version
 
             cdu = server_dao.get_download_info(p_id, p_version)
             if cdu:
@@ -131,28 +195,28 @@ def check_plugin_xml():
             if archive_size is None:
                 return to_web_msg(MessageEnum.BAD_REQUEST, hint='parameter archive_size is required')
 
+            # 新版客户端声明分片数，合并前据此检查分片是否完整
+            chunk_count = request.form.get('chunk_count')
+            if chunk_count is not None:
+                if not chunk_count.isdigit() or int(chunk_count) <= 0 or not archive_size.isdigit():
+                    return to_web_msg(MessageEnum.BAD_REQUEST, hint='invalid chunk_count or archive_size')
+                chunk_count = int(chunk_count)
+
             archive_suffix = archive_name[archive_name.rfind('.'):]
 
-            p_name = plugin.find('name').text
-            p_description = plugin.find('description').text if plugin.find('description') is not None else None
-            p_version = plugin.find('version').text
-            p_vendor = plugin.find('vendor')
-            p_vendor_name = p_vendor.text if p_vendor.text is not None else user_name
-            p_vendor_email = p_vendor.attrib.get('email')
-            p_vendor_url = p_vendor.attrib.get('url')
-            p_change_notes = plugin.find('change-notes').text
-            p_idea_version = plugin.find('idea-version')
-            p_since_build = p_idea_version.attrib.get('since-build')
-            p_until_build = p_idea_version.attrib.get('until-build')
-
-            vendor_id = get_vendor_id(p_vendor_email, p_vendor_name, p_vendor_url)
-
-            server_dao.add_new_plugin_info(p_name, p_id, p_description, p_version, p_change_notes, p_since_build,
-                                           p_until_build, archive_size=archive_size,
-                                           release_time=datetime.datetime.now(), vendor_id=vendor_id)
+            vendor_id = get_vendor_id(descriptor.vendor_email,
+                                      descriptor.vendor_name if descriptor.vendor_name is not None else user_name,
+                                      descriptor.vendor_url)
+
+            server_dao.add_new_plugin_info(descriptor.name, p_id, descriptor.description, p_version,
+                                           descriptor.change_notes, descriptor.since_build, descriptor.until_build,
+                                           archive_size=archive_size, release_time=datetime.datetime.now(),
+                                           vendor_id=vendor_id)
             batch_no = common_utils.generate_random_str()
             server_dao.save_batch_info(batch_no, p_id, p_version, archive_name, archive_suffix,
-                                       p_since_build, p_until_build)
+                                       descriptor.since_build, descriptor.until_build, chunk_count=chunk_count,
+                                       archive_size=int(archive_size) if chunk_count else None,
+                                       user_name=user_name)
             server_dao.update_tmp_ticket_step(tmp_ticket, 2)
 
             return to_web_msg(MessageEnum.SUCCESS, biz_content={'batch_no': batch_no})
@@ -173,24 +237,67 @@ def get_vendor_id(p_vendor_email, p_vendor_name, p_vendor_url):
     return vendor_id
 
 
-def validate_ticket(access_token, tmp_ticket, last_step):
+def get_gitee_login(access_token):
+    """
+    通过Gitee用户接口获取access_token对应的用户名，成功的结果会缓存
+    :return: (用户名, 失败原因)，接口调用成功时失败原因为None
+    """
+    login = user_cache.get(access_token)
+    if login is not None:
+        return login, None
+
+    gitee_api = app.config['gitee_api']
+    with requests_mock.Mocker() as m:
+        m.get(''.join([gitee_api, '/user']), json={'login': 'JetBrains'}, status_code=200)
+        auth_check_resp = requests.get(''.join([gitee_api, '/user']), params={'access_token': access_token})
+    if auth_check_resp.status_code != 200:
+        return None, auth_check_resp.reason
+
+    login = auth_check_resp.json()['login']
+    if login:
+        user_cache.put(access_token, login)
+    return login, None
+
+
+def validate_ticket(access_token, tmp_ticket, *last_steps):
+    """
+    :param last_steps: 票据当前允许处于的步骤
+    :return: (是否有效, 用户名)
+    """
     if not access_token or not tmp_ticket:
         return False, None
 
-    ct = server_dao.check_ticket(tmp_ticket, access_token)
+    # 缓存只保存票据中不会变化的字段；步骤会被其它工作进程修改，每次按主键从主库读取
+    ct = ticket_cache.get(tmp_ticket)
     if ct is None:
+        ticket = server_dao.check_ticket(tmp_ticket, access_token)
+        if ticket is None:
+            return False, None
+        ct = CachedTicket(ticket.access_token, ticket.user_name, ticket.create_time)
+        # 缓存不能超过票据的剩余有效期
+        remaining = server_dao.TICKET_VALID_SECONDS - (datetime.datetime.now() - ct.create_time).total_seconds()
+        ticket_cache.put(tmp_ticket, ct, ttl=min(ticket_cache.ttl, remaining))
+        step = ticket.step
+    else:
+        step = server_dao.get_tmp_ticket_step(tmp_ticket)
+
+    if ct.access_token != access_token:
         return False, None
-    elif ct.step != last_step:
-        logger.warning('current step is {}, but last step is {}'.format(last_step, ct.step))
+    elif step not in last_steps:
+        logger.warning('current step is {}, but expect {}'.format(step, last_steps))
         return False, None
 
     return True, ct.user_name
 
 
 def check_developer(developer_name):
+    if developer_cache.get(developer_name):
+        return
     developer_info = server_dao.get_vendor_info_by_name(developer_name)
     if not developer_info:
         raise RuntimeError('You are not a registered developer')
+    # 只缓存已注册的开发者，新注册的开发者无需等待缓存过期
+    developer_cache.put(developer_name, True)
 
 
 @app.route('/api/plugins/chunk/upload', methods=['POST'])
@@ -204,37 +311,120 @@ def upload_chunk():
         if not vt_result or batch_no is None:
             return to_web_msg()
 
-        chunk = request.files.get('chunk')
-        if chunk:
-            archive_name = chunk.filename
-            upload_dir = app.config['upload_dir']
-            save_path_str = ''.join([upload_dir, '/', tmp_ticket, '/'])
-            save_path = Path(save_path_str)
-            if not save_path.exists():
-                save_path.mkdir(parents=True, exist_ok=True)
-
-            saved_archive_path = ''.join([save_path_str, secure_filename(archive_name)])
-            # logger.info('chunk saved to {}'.format(saved_archive_path))
-            chunk.save(saved_archive_path)
-            # archive_size = os.stat(saved_archive_path).st_size
-            expect_md5_sum = common_utils.get_file_md5sum(saved_archive_path)
-            md5_sum = request.form.get('checksum')
-            if md5_sum is None or md5_sum != expect_md5_sum:
-                logger.warning('expect md5sum is {}, but get {}'.format(expect_md5_sum, md5_sum))
-                return to_web_msg(MessageEnum.BAD_REQUEST, hint='md5sum not match')
+        upload_batch_info = get_user_batch_info(batch_no, user_name)
+        if upload_batch_info is None:
+            return to_web_msg(MessageEnum.BAD_REQUEST, hint='Unknown batch_no')
 
+        # application/octet-stream请求体即分片内容，直接从请求流写入文件；multipart方式兼容旧客户端
+        if request.mimetype == 'application/octet-stream':
+            chunk_stream = request.stream
+            md5_sum = request.args.get('checksum')
+            chunk_order = request.args.get('order')
+        else:
+            chunk = request.files.get('chunk')
+            chunk_stream = chunk.stream if chunk else None
+            md5_sum = request.form.get('checksum')
             chunk_order = request.form.get('order')
-            server_dao.save_upload_chunk_info(batch_no, chunk_order, saved_archive_path)
-
-            return to_web_msg(MessageEnum.SUCCESS)
 
-        else:
+        if chunk_stream is None:
             return to_web_msg(MessageEnum.BAD_REQUEST, hint='parameter chunk is required')
+
+        chunk_order = int(chunk_order) if chunk_order is not None and chunk_order.isdigit() else None
+        if chunk_order is None or (upload_batch_info.chunk_count
+                                   and not 1 <= chunk_order <= upload_batch_info.chunk_count):
+            return to_web_msg(MessageEnum.BAD_REQUEST, hint='invalid chunk order')
+
+        # 断点续传时已保存且校验值相同的分片直接跳过
+        saved_chunk = server_dao.get_upload_chunk(batch_no, chunk_order)
+        if (saved_chunk is not None and md5_sum and saved_chunk.checksum == md5_sum
+                and os.path.exists(saved_chunk.saved_path)):
+            return to_web_msg(MessageEnum.SUCCESS, biz_content={'order': chunk_order, 'skipped': True})
+
+        # 分片按批次号存放、按序号命名，各分片可以乱序、并行上传
+        save_path = get_chunk_dir(batch_no)
+        save_path.mkdir(parents=True, exist_ok=True)
+        saved_chunk_path = str(save_path / '{}.chunk'.format(chunk_order))
+        # 写入临时文件的同时计算md5，校验通过后再改名，校验失败的分片不会留在分片目录中
+        part_path = '{}.{}.part'.format(saved_chunk_path, common_utils.generate_random_str(8))
+        try:
+            size, expect_md5_sum = common_utils.save_stream_with_md5(chunk_stream, part_path)
+        except Exception:
+            # 客户端断开或读取出错时删除写了一半的临时文件，否则每次重试都会在分片目录中多留一个
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        if md5_sum is None or md5_sum != expect_md5_sum:
+            os.remove(part_path)
+            logger.warning('expect md5sum is {}, but get {}'.format(expect_md5_sum, md5_sum))
+            return to_web_msg(MessageEnum.BAD_REQUEST, hint='md5sum not match')
+        os.replace(part_path, saved_chunk_path)
+        logger.debug('chunk {} saved, {} bytes'.format(saved_chunk_path, size))
+
+        server_dao.save_upload_chunk_info(batch_no, chunk_order, saved_chunk_path, expect_md5_sum)
+
+        return to_web_msg(MessageEnum.SUCCESS, biz_content={'order': chunk_order, 'skipped': False})
     except Exception as e:
         logger.exception('upload chunk failed', e)
         return to_web_msg(MessageEnum.BAD_REQUEST, hint=str(e))
 
 
+@app.route('/api/plugins/chunk/missing', methods=['GET'])
+def get_missing_chunks():
+    """
+    查询批次中尚未上传的分片，用于断点续传。
+    上传中断后票据可能已失效，客户端重新获取票据后调用该接口，票据随即进入上传分片的步骤
+    """
+    try:
+        access_token = request.args.get('access_token')
+        tmp_ticket = request.args.get('ticket')
+        batch_no = request.args.get('batch_no')
+        vt_result, user_name = validate_ticket(access_token, tmp_ticket, 1, 2)
+
+        if not vt_result or batch_no is None:
+            return to_web_msg()
+
+        upload_batch_info = get_user_batch_info(batch_no, user_name)
+        if upload_batch_info is None:
+            return to_web_msg(MessageEnum.BAD_REQUEST, hint='Unknown batch_no')
+        if upload_batch_info.chunk_count is None:
+            return to_web_msg(MessageEnum.BAD_REQUEST, hint='chunk_count was not declared for this batch')
+
+        received, missing = get_chunk_status(upload_batch_info)
+
+        server_dao.update_tmp_ticket_step(tmp_ticket, 2)
+        return to_web_msg(MessageEnum.SUCCESS, biz_content={'batch_no': batch_no,
+                                                            'chunk_count': upload_batch_info.chunk_count,
+                                                            'received': len(received), 'missing': missing})
+    except Exception as e:
+        logger.exception('query missing chunks failed', e)
+        return to_web_msg(MessageEnum.BAD_REQUEST, hint=str(e))
+
+
+def get_user_batch_info(batch_no, user_name):
+    """
+    获取上传批次，批次记录了上传用户时只允许该用户访问
+    """
+    upload_batch_info = server_dao.get_upload_batch_info(batch_no)
+    if upload_batch_info is None or (upload_batch_info.user_name and upload_batch_info.user_name != user_name):
+        return None
+    return upload_batch_info
+
+
+def get_chunk_dir(batch_no):
+    return Path(app.config['upload_dir']) / batch_no
+
+
+def get_chunk_status(upload_batch_info):
+    """
+    :return: (已上传的分片记录列表, 缺少的分片序号列表)，分片文件已不存在的记录视为缺少
+    """
+    received = [chunk_info for chunk_info in server_dao.get_upload_chunk_info(upload_batch_info.batch_no)
+                if os.path.exists(chunk_info.saved_path)]
+    received_orders = {chunk_info.chunk_order for chunk_info in received}
+    missing = [order for order in range(1, (upload_batch_info.chunk_count or 0) + 1) if order not in received_orders]
+    return received, missing
+
+
 @app.route('/api/plugins/chunk/merge', methods=['GET', 'POST'])
 def merge_chunks():
     try:
@@ -246,11 +436,19 @@ def merge_chunks():
             return to_web_msg()
 
         batch_no = request.args.get('batch_no')
-        upload_batch_info = server_dao.get_upload_batch_info(batch_no)
+        upload_batch_info = get_user_batch_info(batch_no, user_name)
         if upload_batch_info is None:
             return to_web_msg(MessageEnum.BAD_REQUEST)
 
-        upload_chunk_info = server_dao.get_upload_chunk_info(batch_no)
+        upload_chunk_info, missing = get_chunk_status(upload_batch_info)
+        if missing:
+            return to_web_msg(MessageEnum.BAD_REQUEST, hint='missing chunks',
+                              biz_content={'missing': missing})
+        if upload_batch_info.chunk_count:
+            chunk_size_sum = sum(os.path.getsize(chunk_info.saved_path) for chunk_info in upload_chunk_info)
+            if chunk_size_sum != upload_batch_info.archive_size:
+                return to_web_msg(MessageEnum.BAD_REQUEST, hint='expect {} bytes, but received {}'.format(
+                    upload_batch_info.archive_size, chunk_size_sum))
 
         upload_dir = app.config['upload_dir']
         save_path_str = ''.join([upload_dir, '/', upload_batch_info.plugin_id.replace(' ', '_'), '/',
@@ -262,23 +460,62 @@ def merge_chunks():
         saved_archive_path = ''.join([save_path_str, upload_batch_info.plugin_id.replace(' ', '_'), '-',
                                      upload_batch_info.plugin_version, upload_batch_info.archive_suffix])
 
-        with open(saved_archive_path, 'wb') as merged_file:
-            for chunk_info in upload_chunk_info:
-                with open(chunk_info.saved_path, 'rb') as f:
-                    shutil.copyfileobj(f, merged_file)
+        # 按chunk_order合并，分片内容在内核中直接复制到预分配的文件
+        start = time.perf_counter()
+        archive_size = common_utils.merge_files([chunk_info.saved_path for chunk_info in upload_chunk_info],
+                                                saved_archive_path)
+        checksum = None
+        if all(chunk_info.checksum for chunk_info in upload_chunk_info):
+            checksum = common_utils.composite_md5([chunk_info.checksum for chunk_info in upload_chunk_info])
+            server_dao.update_batch_checksum(batch_no, checksum)
+        logger.info('merged {} chunks of batch {} into {} bytes in {:.0f} ms, checksum {}'.format(
+            len(upload_chunk_info), batch_no, archive_size, (time.perf_counter() - start) * 1000, checksum))
+
+        # 以插件包中的plugin.xml为准，与上传前登记的插件和版本不一致时拒绝发布
+        try:
+            descriptor = inspect_plugin_archive(saved_archive_path,
+                                                checksum or common_utils.get_file_md5sum(saved_archive_path))
+            if (descriptor.id, descriptor.version) != (upload_batch_info.plugin_id, upload_batch_info.plugin_version):
+                raise RuntimeError('archive contains {} {}, but {} {} was declared'.format(
+                    descriptor.id, descriptor.version, upload_batch_info.plugin_id, upload_batch_info.plugin_version))
+        except Exception as e:
+            os.remove(saved_archive_path)
+            return to_web_msg(MessageEnum.BAD_REQUEST, hint=str(e))
+        server_dao.update_plugin_archive_size(upload_batch_info.plugin_id, upload_batch_info.plugin_version,
+                                              archive_size)
 
-        chuck_dir = Path(''.join([upload_dir, '/', tmp_ticket, '/']))
+        chuck_dir = get_chunk_dir(batch_no)
         if chuck_dir.exists():
             logger.debug('remove temp dir {}'.format(chuck_dir))
             shutil.rmtree(chuck_dir)
 
-        return upload_to_nexus(saved_archive_path, upload_batch_info)
+        # 发布到Nexus和重新生成目录在后台执行，通过任务id查询进度
+        job_id = submit_publish_job(saved_archive_path, upload_batch_info)
+        return to_web_msg(MessageEnum.SUCCESS, biz_content={'job_id': job_id})
 
     except Exception as e:
         return to_web_msg(MessageEnum.INTERNAL_ERROR, hint=str(e))
 
 
-def upload_to_nexus(saved_archive_path: str, plugin_info: collections.namedtuple):
+def submit_publish_job(saved_archive_path: str, plugin_info):
+    """
+    提交发布插件的后台任务
+    :param plugin_info: 包含PluginInfo各字段的对象
+    :return: 任务id
+    """
+    job_id, _ = job_queue.submit('publish_plugin', {
+        'archive_path': saved_archive_path,
+        'plugin_info': {field: getattr(plugin_info, field) for field in PluginInfo._fields},
+    })
+    return job_id
+
+
+def upload_to_nexus(saved_archive_path: str, plugin_info: collections.namedtuple, extra_files: dict = None):
+    """
+    发布插件包到Nexus
+    :param extra_files: 与插件包一起发布的附加文件{后缀: 文件路径}，发布后的文件名为插件包文件名加后缀
+    :return: 插件包的md5
+    """
     nexus_conf = app.config['nexus']
     nexus_api = nexus_conf['api_url']
     release_repo_id = nexus_conf['release_repo_id']
@@ -291,97 +528,310 @@ def upload_to_nexus(saved_archive_path: str, plugin_info: collections.namedtuple
         # 'maven2.asset1': open(saved_archive_path, 'rb'),
         'maven2.asset1.extension': plugin_info.archive_suffix.replace('.', '')
     }
-    headers = {'User-Agent': app.config['user_agent']}
-    resp = requests.post(''.join([nexus_api, '/components?repository=', release_repo_id]), headers=headers,
-                         data=payload, files={'maven2.asset1': open(saved_archive_path, 'rb')},
-                         auth=(publish_user, publish_password))
-    if resp.status_code == 204:
-        # archive_size = os.stat(saved_archive_path).st_size
-        md5_sum = common_utils.get_file_md5sum(saved_archive_path)
-
-        save_upload_plugin_info(plugin_info.plugin_id, plugin_info.plugin_version, plugin_info.archive_name, md5_sum,
-                                plugin_info.since_build, plugin_info.until_build)
-
-        return to_web_msg(MessageEnum.SUCCESS)
-    else:
-        return to_web_msg(MessageEnum.BAD_REQUEST, hint=resp.reason)
+    extra_assets = {}
+    for i, (suffix, extra_file_path) in enumerate(sorted((extra_files or {}).items()), start=2):
+        payload['maven2.asset{}.extension'.format(i)] = ''.join([payload['maven2.asset1.extension'], suffix])
+        extra_assets['maven2.asset{}'.format(i)] = extra_file_path
+    # 文件从磁盘分块读取发送，发送的同时计算md5
+    encoder = MultipartFileEncoder(payload, 'maven2.asset1', saved_archive_path, extra_files=extra_assets)
+    headers = {'User-Agent': app.config['user_agent'], 'Content-Type': encoder.content_type}
+    try:
+        resp = requests.post(''.join([nexus_api, '/components?repository=', release_repo_id]), headers=headers,
+                             data=encoder, auth=(publish_user, publish_password))
+    finally:
+        encoder.close()
+    logger.info('uploaded {} ({} bytes) to nexus in {:.1f}s, {:.2f} MB/s, status {}'.format(
+        saved_archive_path, encoder.sent_bytes, encoder.elapsed, encoder.throughput, resp.status_code))
+    if resp.status_code != 204:
+        raise RuntimeError('upload to nexus failed: {} {}'.format(resp.status_code, resp.reason))
+    return encoder.md5 or common_utils.get_file_md5sum(saved_archive_path)
 
 
 def save_upload_plugin_info(plugin_id, version, archive_name, md5_sum, since_build, until_build):
     # 根据since_build和until_build获取支持的IDE版本
-    support_ide = server_dao.get_support_ide_range(since_build, until_build)
+    support_ide = ide_index.builds_between(since_build, until_build)
 
     # 写入support_version，并将之前的版本设为非最新版本移动到历史表
-    new_support_version = [(plugin_id, version, row.product_code, row.build_version)
-                           for row in support_ide.namedtuples().iterator()]
+    new_support_version = [(plugin_id, version, row.product_code, row.build_version) for row in support_ide]
     server_dao.add_new_support_version(new_support_version)
 
-    ide_version_tuple = [(row.product_code, row.build_version) for row in support_ide.namedtuples().iterator()]
+    ide_version_tuple = [(row.product_code, row.build_version) for row in support_ide]
     server_dao.move_old_support_version(plugin_id, version, ide_version_tuple)
     server_dao.remove_old_support_version(plugin_id, version, ide_version_tuple)
 
     # 新增download_info
     server_dao.add_new_download_info(plugin_id, version, archive_name, md5_sum)
 
-    # 更新xml
-    handler = plugins_handler.PluginsHandler()
-    # handler.generate_all_update_plugins_xml()
-    for ide in support_ide.namedtuples().iterator():
-        handler.generate_update_plugins_xml(ide.product_code, ide.build_version)
+    # 该插件的版本、开发者等信息都可能变化，重新计算其全部目录记录
+    server_dao.refresh_catalog_entries(plugin_ids=[plugin_id])
+    with server_dao.replica_router.primary_reads():
+        plugin_index.refresh_plugins([plugin_id])
 
+    return ide_version_tuple
 
-def handle_plugin_xml(user_name):
-    plugin_xml = request.files['plugin_xml']
-    if plugin_xml:
-        plugin = etree.fromstring(plugin_xml.read(), parser=etree.XMLParser(strip_cdata=False, resolve_entities=False))
-        p_id = plugin.find('id').text
-        p_name = plugin.find('name').text
-        p_description = plugin.find('description').text if plugin.find('description') is None else None
-        p_version = plugin.find('version').text
-        p_vendor = plugin.find('vendor')
-        p_vendor_name = p_vendor.text if p_vendor.text else user_name
-        p_vendor_email = p_vendor.attrib.get('email')
-        p_vendor_url = p_vendor.attrib.get('url')
-        p_change_notes = plugin.find('change-notes').text
-        p_idea_version = plugin.find('idea-version')
-        p_since_build = p_idea_version.attrib.get('since-build')
-        p_until_build = p_idea_version.attrib.get('until-build')
-
-        cdu = server_dao.get_download_info(p_id, p_version)
-        if cdu:
-            raise RuntimeError('Duplicate upload')
 
-        # 保存插件文件
-        archive_name, archive_size, md5_sum, saved_archive_path = handle_archive_file(p_id, p_version)
-
-        vendor_id = get_vendor_id(p_vendor_email, p_vendor_name, p_vendor_url)
-        # 新增插件信息
-        server_dao.add_new_plugin_info(p_name, p_id, p_description, p_version, p_change_notes, p_since_build,
-                                       p_until_build, archive_size=archive_size, release_time=datetime.datetime.now(),
-                                       vendor_id=vendor_id)
-
-        PluginInfo = collections.namedtuple('PluginInfo', ['plugin_id', 'plugin_version', 'archive_name',
-                                                           'archive_suffix', 'since_build', 'until_build'])
-        plugin_info = PluginInfo(plugin_id=p_id, plugin_version=p_version, archive_name=archive_name,
-                                 archive_suffix=archive_name[archive_name.rfind('.'):],
-                                 since_build=p_since_build, until_build=p_until_build)
-        upload_to_nexus(saved_archive_path, plugin_info)
+def publish_plugin(payload: dict, context):
+    """
+    后台任务：发布插件包到Nexus，写入插件支持的IDE版本，再为受影响的目录提交重新生成任务
+    """
+    plugin_info = PluginInfo(**payload['plugin_info'])
+    # 发布仓库不允许重复部署，已上传成功时重试直接使用上次的结果
+    if payload.get('nexus_md5'):
+        md5_sum = payload['nexus_md5']
+        blockmap_stats = payload.get('blockmap')
+        logger.info('{} was uploaded to nexus by a previous attempt'.format(payload['archive_path']))
+    else:
+        context.progress(0, 4, 'generating blockmap')
+        sidecars, blockmap_stats = generate_blockmap(payload['archive_path'], plugin_info)
+
+        context.progress(1, 4, 'uploading to nexus')
+        md5_sum = upload_to_nexus(payload['archive_path'], plugin_info, sidecars)
+        context.checkpoint(dict(payload, nexus_md5=md5_sum, blockmap=blockmap_stats))
+
+    context.progress(2, 4, 'saving plugin info')
+    ide_version_tuple = save_upload_plugin_info(plugin_info.plugin_id, plugin_info.plugin_version,
+                                                plugin_info.archive_name, md5_sum, plugin_info.since_build,
+                                                plugin_info.until_build)
+
+    context.progress(3, 4, 'scheduling catalog regeneration')
+    catalog_jobs = schedule_catalog_regeneration(ide_version_tuple)
+    context.progress(4, 4)
+    return {'md5': md5_sum, 'catalog_jobs': catalog_jobs, 'blockmap': blockmap_stats}
+
+
+def generate_blockmap(archive_path: str, plugin_info):
+    """
+    生成差量更新用的.blockmap.zip和.hash.json，并与该插件上一个版本比较，统计差量更新需要下载的数据量。
+    生成失败时只记录日志，插件仍按完整下载发布
+    :return: ({后缀: 附加文件路径}, 统计信息)
+    """
+    if not app.config['blockmap']['enabled']:
+        return {}, None
+    if not blockmap.is_available():
+        logger.warning('fastcdc is not installed, skip blockmap of {}'.format(archive_path))
+        return {}, None
+
+    try:
+        sidecars = blockmap.write_sidecars(archive_path)
+        stats = {'chunks': len(sidecars.chunks), 'elapsed_ms': round(sidecars.elapsed * 1000),
+                 'throughput': round(sidecars.size / 1024 / 1024 / sidecars.elapsed, 1) if sidecars.elapsed else None}
+        previous = find_previous_blockmap(archive_path, plugin_info.plugin_version)
+        if previous:
+            stats['previous_version'] = previous[0]
+            stats.update(blockmap.compare(blockmap.read_blockmap(previous[1]), sidecars.chunks))
+        logger.info('blockmap of {} generated: {}'.format(archive_path, stats))
+    except Exception as e:
+        logger.exception('generate blockmap of {} failed'.format(archive_path), e)
+        return {}, None
+    return {blockmap.BLOCKMAP_SUFFIX: sidecars.blockmap_path, blockmap.HASH_SUFFIX: sidecars.hash_path}, stats
+
+
+def find_previous_blockmap(archive_path: str, version: str):
+    """
+    在插件目录(<插件>/<版本>/<插件包>)中查找低于指定版本的最新版本的blockmap
+    :return: (版本, blockmap路径)，没有时返回None
+    """
+    candidates = []
+    for version_dir in Path(archive_path).parent.parent.iterdir():
+        if not version_dir.is_dir() or build_key(version_dir.name) >= build_key(version):
+            continue
+        for blockmap_file in version_dir.glob(''.join(['*', blockmap.BLOCKMAP_SUFFIX])):
+            candidates.append((build_key(version_dir.name), version_dir.name, str(blockmap_file)))
+    if not candidates:
+        return None
+    _, previous_version, blockmap_path = max(candidates)
+    return previous_version, blockmap_path
+
+
+def schedule_catalog_regeneration(ide_version_tuple):
+    """
+    为受影响的IDE版本(per_build)或产品(per_product)提交目录重新生成任务，all模式只有一个目录，只提交一个任务。
+    尚未开始执行的相同目录的任务会合并
+    :return: 任务id列表
+    """
+    layout = app.config['catalog']['layout']
+    if layout == 'per_build':
+        catalogs = [(product_code, build_version) for product_code, build_version in ide_version_tuple]
+    elif layout == 'per_product':
+        catalogs = sorted({(product_code, None) for product_code, _ in ide_version_tuple})
     else:
-        raise ValueError('param plugin_xml is required')
+        catalogs = [(None, None)] if ide_version_tuple else []
+
+    job_ids = []
+    for product_code, build_version in catalogs:
+        job_id, _ = job_queue.submit('regenerate_catalog', {'product_code': product_code,
+                                                            'build_version': build_version},
+                                     coalesce_key=':'.join(filter(None, ['catalog', product_code, build_version])))
+        job_ids.append(job_id)
+    return job_ids
+
+
+def regenerate_catalog(payload: dict, context):
+    """
+    后台任务：重新生成一个目录文件
+    """
+    # 刚写入的数据可能还未同步到从库，从主库读取
+    with server_dao.replica_router.primary_reads():
+        if payload.get('build_version'):
+            handler.generate_update_plugins_xml(payload['product_code'], payload['build_version'])
+        else:
+            handler.generate_consolidated_update_plugins_xml(payload['product_code'])
+
+
+job_queue_conf = app.config['job_queue']
+job_queue = JobQueue(workers=job_queue_conf['workers'], poll_interval=job_queue_conf['poll_interval'],
+                     lease_seconds=job_queue_conf['lease_seconds'], max_attempts=job_queue_conf['max_attempts'],
+                     retry_delay=job_queue_conf['retry_delay'])
+job_queue.register('publish_plugin', publish_plugin)
+job_queue.register('regenerate_catalog', regenerate_catalog)
+_background_lock = threading.Lock()
+_background_pid = None
+
+
+def start_background_workers():
+    """
+    启动后台任务队列和插件索引的刷新线程。线程不会随fork复制到子进程，
+    多进程部署时在每个工作进程中启动(serve.py的post_worker_init，或收到第一个请求时)
+    """
+    global _background_pid
+    with _background_lock:
+        if _background_pid == os.getpid():
+            return
+        _background_pid = os.getpid()
+    job_queue.start()
+    plugin_index.start()
+
+
+def stop_background_workers(timeout=None):
+    job_queue.stop(timeout)
+    plugin_index.stop(timeout)
+
+
+@app.before_request
+def ensure_background_workers():
+    if _background_pid != os.getpid():
+        start_background_workers()
+
+
+@app.route('/api/plugins/jobs/<int:job_id>', methods=['GET'])
+def get_job_status(job_id):
+    status = job_queue.status(job_id)
+    if status is None:
+        return to_web_msg(MessageEnum.NOT_FOUND, hint='Unknown job')
+
+    # 发布任务附带其提交的目录重新生成任务的状态
+    if status['result'] and status['result'].get('catalog_jobs'):
+        status['catalog_jobs'] = [job_queue.status(catalog_job_id)
+                                  for catalog_job_id in status['result']['catalog_jobs']]
+    return to_web_msg(MessageEnum.SUCCESS, biz_content=status)
+
+
+@app.route('/api/plugins/search', methods=['GET'])
+def search_plugins():
+    """
+    搜索插件，参数q为查询词，product_code和build过滤兼容的产品和IDE构建版本，page和page_size分页
+    """
+    search_conf = app.config['plugin_index']
+    page = request.args.get('page', 1, type=int)
+    page_size = request.args.get('page_size', search_conf['page_size'], type=int)
+    if page < 1 or not 1 <= page_size <= search_conf['max_page_size']:
+        return to_web_msg(MessageEnum.BAD_REQUEST, hint='invalid page or page_size')
+
+    total, results = plugin_index.search(request.args.get('q'), request.args.get('product_code'),
+                                         request.args.get('build'), page, page_size)
+    items = []
+    for document, version in results:
+        item = plugin_version_to_dict(version)
+        item.update({'id': document.id, 'name': document.name, 'vendor': document.vendor_name,
+                     'tags': document.tags})
+        items.append(item)
+    return to_web_msg(MessageEnum.SUCCESS, biz_content={'total': total, 'page': page, 'page_size': page_size,
+                                                        'items': items})
+
+
+@app.route('/api/plugins/<plugin_id>/versions', methods=['GET'])
+def get_plugin_versions(plugin_id):
+    document = plugin_index.get(plugin_id)
+    if document is None:
+        return to_web_msg(MessageEnum.NOT_FOUND, hint='Unknown plugin')
+
+    versions = plugin_index.compatible_versions(document, request.args.get('product_code'),
+                                                request.args.get('build'))
+    return to_web_msg(MessageEnum.SUCCESS, biz_content={
+        'id': document.id, 'name': document.name, 'vendor': document.vendor_name, 'tags': document.tags,
+        'versions': [plugin_version_to_dict(version) for version in versions],
+    })
+
+
+def plugin_version_to_dict(version):
+    return {
+        'version': version.version,
+        'since_build': version.since_build,
+        'until_build': version.until_build,
+        'rating': version.rating,
+        'archive_size': version.archive_size,
+        'release_time': str(version.release_time) if version.release_time else None,
+        'archive_suffix': version.archive_suffix,
+        'product_codes': sorted(version.product_codes),
+    }
+
 
+@app.route('/api/stats/cache', methods=['GET'])
+def get_cache_stats():
+    return to_web_msg(MessageEnum.SUCCESS, biz_content={
+        'catalog': catalog_cache.stats(),
+        'ticket': ticket_cache.stats(),
+        'user': user_cache.stats(),
+        'developer': developer_cache.stats(),
+        'descriptor': descriptor_cache.stats(),
+        'plugin_index': plugin_index.stats(),
+    })
 
-def handle_archive_file(plugin_id, plugin_version):
+
+def handle_plugin_xml(user_name):
+    # 先保存插件包，插件信息从插件包中的plugin.xml读取，不再信任客户端单独上传的plugin.xml
+    archive_name, archive_size, md5_sum, received_archive_path = handle_archive_file()
+    try:
+        descriptor = inspect_plugin_archive(received_archive_path, md5_sum)
+        cdu = server_dao.get_download_info(descriptor.id, descriptor.version)
+        if cdu:
+            raise RuntimeError('Duplicate upload')
+    except Exception:
+        shutil.rmtree(Path(received_archive_path).parent)
+        raise
+
+    upload_dir = app.config['upload_dir']
+    save_path = Path(''.join([upload_dir, '/', descriptor.id.replace(' ', '_'), '/', descriptor.version, '/']))
+    save_path.mkdir(parents=True, exist_ok=True)
+    saved_archive_path = str(save_path / archive_name)
+    os.replace(received_archive_path, saved_archive_path)
+    shutil.rmtree(Path(received_archive_path).parent)
+
+    vendor_id = get_vendor_id(descriptor.vendor_email, descriptor.vendor_name or user_name, descriptor.vendor_url)
+    # 新增插件信息
+    server_dao.add_new_plugin_info(descriptor.name, descriptor.id, descriptor.description, descriptor.version,
+                                   descriptor.change_notes, descriptor.since_build, descriptor.until_build,
+                                   archive_size=archive_size, release_time=datetime.datetime.now(),
+                                   vendor_id=vendor_id)
+
+    plugin_info = PluginInfo(plugin_id=descriptor.id, plugin_version=descriptor.version, archive_name=archive_name,
+                             archive_suffix=archive_name[archive_name.rfind('.'):],
+                             since_build=descriptor.since_build, until_build=descriptor.until_build)
+    return submit_publish_job(saved_archive_path, plugin_info)
+
+
+def handle_archive_file():
+    """
+    将上传的插件包保存到以随机串命名的临时目录，确定插件和版本后再移动到插件目录
+    :return: (文件名, 文件大小, md5, 保存路径)
+    """
     archive = request.files.get('archive')
     if archive:
-        archive_name = archive.filename
-        upload_dir = app.config['upload_dir']
-        save_path_str = ''.join([upload_dir, '/', plugin_id.replace(' ', '_'), '/', plugin_version, '/'])
-        save_path = Path(save_path_str)
-        if not save_path.exists():
-            save_path.mkdir(parents=True, exist_ok=True)
+        archive_name = secure_filename(archive.filename)
+        save_path = Path(app.config['upload_dir']) / common_utils.generate_random_str()
+        save_path.mkdir(parents=True, exist_ok=True)
 
-        archive_name = secure_filename(archive_name)
-        saved_archive_path = ''.join([save_path_str, archive_name])
+        saved_archive_path = str(save_path / archive_name)
         archive.save(saved_archive_path)
         archive_size = os.stat(saved_archive_path).st_size
         md5_sum = common_utils.get_file_md5sum(saved_archive_path)
@@ -390,5 +840,17 @@ def handle_archive_file(plugin_id, plugin_version):
         raise ValueError('param archive is required')
 
 
+def inspect_plugin_archive(archive_path, digest):
+    """
+    读取插件包中的plugin.xml，解析结果按插件包的摘要缓存
+    """
+    descriptor = descriptor_cache.get(digest)
+    if descriptor is None:
+        descriptor = plugin_archive.inspect_archive(archive_path)
+        descriptor_cache.put(digest, descriptor)
+    return descriptor
+
+
 if __name__ == '__main__':
+    # 开发调试用，生产环境使用serve.py
     app.run(port=8080)
@@ -1,39 +1,68 @@
 import datetime
 import operator
 from functools import reduce
-from peewee import NodeList
 
 from data_access import *
+from db_metrics import traced
 
+# 临时票据的有效期秒数
+TICKET_VALID_SECONDS = 120
 
+
+@traced
 def check_register_plugin(plugin_id: str):
     return WhiteList.get_or_none((WhiteList.plugin_id == plugin_id) & (WhiteList.enabled == 1))
 
 
+@traced
 def get_download_info(plugin_id: str, version: str):
     return DownloadInfo.get_or_none((DownloadInfo.id == plugin_id) & (DownloadInfo.version == version))
 
 
+@traced
+def get_download_info_by_ide(product_code: str, build_version: str):
+    return (DownloadInfo
+            .select(DownloadInfo.id, DownloadInfo.version, DownloadInfo.archive_name)
+            .join(SupportVersion, on=((DownloadInfo.id == SupportVersion.id)
+                                      & (DownloadInfo.version == SupportVersion.version)))
+            .where((SupportVersion.product_code == product_code)
+                   & (SupportVersion.build_version == build_version)
+                   & (SupportVersion.latest_version == 1)))
+
+
+@traced
 def check_ticket(ticket: str, access_token: str):
     return TmpTicket.get_or_none((TmpTicket.ticket == ticket)
                                  & (TmpTicket.access_token == access_token)
-                                 & (fn.TIMESTAMPDIFF(SQL('SECOND'), TmpTicket.create_time, fn.NOW()) < 120)
+                                 & (TmpTicket.create_time > seconds_ago(TICKET_VALID_SECONDS))
                                  )
 
 
+@traced
+def get_tmp_ticket_step(ticket: str):
+    """
+    :return: 票据当前的步骤，票据不存在时返回None
+    """
+    return TmpTicket.select(TmpTicket.step).where(TmpTicket.ticket == ticket).scalar()
+
+
+@traced
 def get_valid_tmp_ticket(access_token: str):
     return (TmpTicket
             .select(TmpTicket.ticket)
             .where((TmpTicket.access_token == access_token)
-                   & (fn.TIMESTAMPDIFF(SQL('SECOND'), TmpTicket.create_time, fn.NOW()) < 20))
+                   & (TmpTicket.create_time > seconds_ago(20)))
             .order_by(TmpTicket.create_time.desc())
             .limit(1))
 
 
+@traced
 def save_tmp_ticket(ticket: str, access_token: str, user_name: str):
-    TmpTicket.create(ticket=ticket, access_token=access_token, user_name=user_name)
+    # 显式写入步骤1，已按旧模型(DEFAULT 0)建表的库也能通过spec/check的步骤校验
+    TmpTicket.create(ticket=ticket, access_token=access_token, user_name=user_name, step=1)
 
 
+@traced
 def reset_tmp_ticket_step(ticket: str, step: int = 1):
     (TmpTicket
      .update(step=step, update_time=datetime.datetime.now())
@@ -41,21 +70,44 @@ def reset_tmp_ticket_step(ticket: str, step: int = 1):
      .execute())
 
 
+@traced
 def update_tmp_ticket_step(ticket: str, step: int):
     TmpTicket.update(step=step).where(TmpTicket.ticket == ticket).execute()
 
 
-def get_support_ide_range(since_build: str, until_build: str = None):
-    return (IdeVersion.select(IdeVersion.product_code, IdeVersion.build_version, IdeVersion.version)
-            .where((fn.version_compare(IdeVersion.build_version, since_build) <= 0)
-                   & (fn.ISNULL(until_build) | (fn.version_compare(IdeVersion.build_version, until_build) >= 0)))
-            .order_by(IdeVersion.build_version.desc()))
+@traced
+def get_ide_version(product_code: str, build_version: str):
+    return IdeVersion.get_or_none((IdeVersion.product_code == product_code)
+                                  & (IdeVersion.build_version == build_version))
 
 
+@traced
+def touch_ide_versions(ide_info: list = None, batch_size: int = 500):
+    """
+    刷新IDE版本的update_time并增加目录版本号，标记该版本的插件目录已变化
+    :param ide_info: [(product_code, build_version), ...]，为None时标记全部IDE版本
+    :param batch_size: 每条update语句的IDE版本数
+    """
+    update_query = IdeVersion.update(update_time=datetime.datetime.now(),
+                                     catalog_generation=IdeVersion.catalog_generation + 1)
+    if ide_info is None:
+        update_query.execute()
+        return
+    for batch in chunked(sorted(set(ide_info)), batch_size):
+        update_query.where(Tuple(IdeVersion.product_code, IdeVersion.build_version).in_(batch)).execute()
+
+
+# catalog_entry变化后的回调，参数为目录有变化的[(product_code, build_version), ...]，None表示全部，
+# 用于清理本进程的目录缓存；其它进程按catalog_generation的变化重新生成
+catalog_change_listeners = []
+
+
+@traced
 def get_ide_versions():
     return IdeVersion.select().order_by(IdeVersion.product_code, IdeVersion.build_version.desc())
 
 
+@traced
 def add_new_support_version(new_data: list):
     (SupportVersion
      .insert_many(new_data, fields=[SupportVersion.id, SupportVersion.version,
@@ -64,6 +116,7 @@ def add_new_support_version(new_data: list):
      .execute())
 
 
+@traced
 def update_old_support_version(plugin_id: str, plugin_version: str, ide_info: list):
     (SupportVersion
      .update(latest_version='0')
@@ -75,6 +128,7 @@ def update_old_support_version(plugin_id: str, plugin_version: str, ide_info: li
      .execute())
 
 
+@traced
 def move_old_support_version(plugin_id: str, plugin_version: str, ide_info: list):
     (SupportVersionHistory
      .insert_from(
@@ -94,6 +148,7 @@ def move_old_support_version(plugin_id: str, plugin_version: str, ide_info: list
      )
 
 
+@traced
 def remove_old_support_version(plugin_id: str, plugin_version: str, ide_info: list):
     (SupportVersion
      .delete()
@@ -105,6 +160,7 @@ def remove_old_support_version(plugin_id: str, plugin_version: str, ide_info: li
      .execute())
 
 
+@traced
 def remove_old_ide_support_version(plugin_id: str, plugin_version: str, product_code: str, build_version: str):
     (SupportVersion
      .delete()
@@ -116,13 +172,77 @@ def remove_old_ide_support_version(plugin_id: str, plugin_version: str, product_
      .execute())
 
 
+@traced
+def rotate_support_versions(product_code: str, build_version: str, plugin_versions: list, batch_size: int = 500):
+    """
+    按IDE版本批量轮换插件支持版本：比新版本旧的记录移入历史表并删除，再写入新版本。
+    新版本先写入临时表，整个IDE版本只需执行固定的几条语句
+    :param product_code: 产品代码
+    :param build_version: IDE构建版本
+    :param plugin_versions: [(plugin_id, version, base_version), ...]，base_version为用于比较的版本号
+    :param batch_size: 写入临时表时每条insert语句的行数
+    """
+    if not plugin_versions:
+        return
+
+    TmpSupportRotation.create_table(safe=True, temporary=True)
+    try:
+        with db.atomic():
+            for batch in chunked(plugin_versions, batch_size):
+                (TmpSupportRotation
+                 .insert_many(batch, fields=[TmpSupportRotation.id, TmpSupportRotation.version,
+                                             TmpSupportRotation.base_version])
+                 .execute())
+
+            old_versions = (SupportVersion
+                            .select(SupportVersion.id, SupportVersion.version,
+                                    SupportVersion.product_code, SupportVersion.build_version)
+                            .join(TmpSupportRotation, on=(SupportVersion.id == TmpSupportRotation.id))
+                            .where((SupportVersion.product_code == product_code)
+                                   & (SupportVersion.build_version == build_version)
+                                   & (fn.version_compare(SupportVersion.version, TmpSupportRotation.base_version) > 0)))
+
+            (SupportVersionHistory
+             .insert_from(old_versions, fields=[SupportVersionHistory.id, SupportVersionHistory.version,
+                                                SupportVersionHistory.product_code,
+                                                SupportVersionHistory.build_version])
+             .on_conflict_ignore()
+             .execute())
+
+            # MySQL不允许在DELETE的子查询中直接引用被删除的表，包一层派生表使其先物化
+            old_versions = old_versions.alias('old_versions')
+            old_keys = Select([old_versions], [old_versions.c.id, old_versions.c.version])
+            (SupportVersion
+             .delete()
+             .where((SupportVersion.product_code == product_code)
+                    & (SupportVersion.build_version == build_version)
+                    & Tuple(SupportVersion.id, SupportVersion.version).in_(old_keys))
+             .execute())
+
+            (SupportVersion
+             .insert_from(TmpSupportRotation.select(TmpSupportRotation.id, TmpSupportRotation.version,
+                                                    Value(product_code), Value(build_version)),
+                          fields=[SupportVersion.id, SupportVersion.version,
+                                  SupportVersion.product_code, SupportVersion.build_version])
+             .on_conflict_ignore()
+             .execute())
+
+            # 同步任务会更新该IDE版本下插件的全部信息，整体重算该IDE版本的目录
+            refresh_catalog_entries(ide_info=[(product_code, build_version)])
+    finally:
+        TmpSupportRotation.drop_table(safe=True)
+
+
+@traced
 def add_new_plugin_base_info(name: str, plugin_id: str, description: str):
     (PluginsBaseInfo
      .insert(name=name, id=plugin_id, description=description)
-     .on_conflict(update={PluginsBaseInfo.name: name, PluginsBaseInfo.description: description})
+     .on_conflict(conflict_target=conflict_target(PluginsBaseInfo.id),
+                  update={PluginsBaseInfo.name: name, PluginsBaseInfo.description: description})
      .execute())
 
 
+@traced
 def add_new_plugin_version_info(plugin_id: str, version: str, change_notes: str, since_build, until_build, rating=0,
                                 archive_size=0, release_time=None, tags=None, vendor_id=None):
     (PluginsVersionInfo
@@ -132,6 +252,7 @@ def add_new_plugin_version_info(plugin_id: str, version: str, change_notes: str,
      .execute())
 
 
+@traced
 def add_new_plugin_info(name, plugin_id, description, version, change_notes, since_build, until_build, rating=0,
                         archive_size=0, release_time=None, tags=None, vendor_id=None):
     add_new_plugin_base_info(name, plugin_id, description)
@@ -139,6 +260,7 @@ def add_new_plugin_info(name, plugin_id, description, version, change_notes, sin
                                 release_time, tags, vendor_id)
 
 
+@traced
 def add_new_download_info(plugin_id, version, archive_name, md5):
     (DownloadInfo
      .insert(id=plugin_id, version=version, archive_name=archive_name, md5=md5,
@@ -147,85 +269,133 @@ def add_new_download_info(plugin_id, version, archive_name, md5):
      .execute())
 
 
+@traced
+def add_download_infos(download_list: list, batch_size: int = 500):
+    """
+    批量新增下载信息
+    :param download_list: [(plugin_id, version, archive_name, md5), ...]
+    :param batch_size: 每条insert语句的行数
+    """
+    rows = [(plugin_id, version, archive_name, md5, archive_name[archive_name.rindex('.'):])
+            for plugin_id, version, archive_name, md5 in download_list]
+    with db.atomic():
+        for batch in chunked(rows, batch_size):
+            (DownloadInfo
+             .insert_many(batch, fields=[DownloadInfo.id, DownloadInfo.version, DownloadInfo.archive_name,
+                                         DownloadInfo.md5, DownloadInfo.archive_suffix])
+             .on_conflict_ignore()
+             .execute())
+        refresh_catalog_entries(plugin_ids=[row[0] for row in rows])
+
+
+@traced
 def get_vendor_info_by_name(name):
     return VendorInfo.get_or_none(VendorInfo.name == name)
 
 
+@traced
 def add_vendor_info(v_id, name, email, url, dev_type: str = None):
     VendorInfo.create(id=v_id, name=name, email=email, url=url, dev_type=dev_type)
 
 
+@traced
 def check_vendor_info(name, email, url):
     return VendorInfo.get_or_none((VendorInfo.name == name)
-                                  & ((VendorInfo.email == email) | fn.ISNULL(email))
-                                  & ((VendorInfo.url == url) | fn.ISNULL(url)))
+                                  & ((VendorInfo.email == email) | Value(email).is_null())
+                                  & ((VendorInfo.url == url) | Value(url).is_null()))
 
 
+@traced
 def update_vendor_info(v_id, name, email, url):
     (VendorInfo
      .update(name=name, email=email, url=url, update_time=datetime.datetime.now())
      .where(VendorInfo.id == v_id)
      .execute())
+    refresh_catalog_entries(plugin_ids=[row.id for row in PluginsVersionInfo.select(PluginsVersionInfo.id)
+                            .where(PluginsVersionInfo.vendor_id == v_id).distinct()])
 
 
+@traced
 def get_upload_batch_info(batch_no):
     return UploadBatchInfo.get_or_none(batch_no=batch_no)
 
 
+@traced
 def get_upload_chunk_info(batch_no):
-    return UploadChunkInfo.select().where(UploadChunkInfo.batch_no == batch_no)
+    return (UploadChunkInfo
+            .select()
+            .where(UploadChunkInfo.batch_no == batch_no)
+            .order_by(UploadChunkInfo.chunk_order))
 
 
+@traced
 def update_plugin_archive_size(plugin_id, version, archive_size):
     (PluginsVersionInfo
      .update(archive_size=archive_size, update_time=datetime.datetime.now())
-     .where((PluginsVersionInfo.id == plugin_id) & (PluginsVersionInfo.version == version)))
+     .where((PluginsVersionInfo.id == plugin_id) & (PluginsVersionInfo.version == version))
+     .execute())
 
 
+@traced
 def get_plugin_version_info(plugin_id, version):
     return (PluginsVersionInfo
             .get_or_none((PluginsVersionInfo.id == plugin_id) & (PluginsVersionInfo.version == version)))
 
 
-def save_batch_info(batch_no, plugin_id, plugin_version, archive_name=None, archive_suffix=None, since_build=None, until_build=None):
+@traced
+def save_batch_info(batch_no, plugin_id, plugin_version, archive_name=None, archive_suffix=None, since_build=None,
+                    until_build=None, chunk_count=None, archive_size=None, user_name=None):
     UploadBatchInfo.create(batch_no=batch_no, plugin_id=plugin_id, plugin_version=plugin_version,
                            archive_name=archive_name, archive_suffix=archive_suffix,
-                           since_build=since_build, until_build=until_build)
+                           since_build=since_build, until_build=until_build,
+                           chunk_count=chunk_count, archive_size=archive_size, user_name=user_name)
+
+
+@traced
+def update_batch_checksum(batch_no, checksum):
+    (UploadBatchInfo
+     .update(checksum=checksum, update_time=datetime.datetime.now())
+     .where(UploadBatchInfo.batch_no == batch_no)
+     .execute())
+
+
+@traced
+def save_upload_chunk_info(batch_no, chunk_order, saved_path, checksum=None):
+    """
+    保存分片记录，重传的分片覆盖之前的记录
+    """
+    (UploadChunkInfo
+     .insert(batch_no=batch_no, chunk_order=chunk_order, saved_path=saved_path, checksum=checksum)
+     .on_conflict(conflict_target=conflict_target(UploadChunkInfo.batch_no, UploadChunkInfo.chunk_order),
+                  update={UploadChunkInfo.saved_path: saved_path, UploadChunkInfo.checksum: checksum,
+                          UploadChunkInfo.update_time: datetime.datetime.now()})
+     .execute())
 
 
-def save_upload_chunk_info(batch_no, chunk_order, saved_path):
-    UploadChunkInfo.create(batch_no=batch_no, chunk_order=chunk_order, saved_path=saved_path)
-    # UploadChunkInfo.insert(batch_no=batch_no, chunk_order=chunk_order, saved_path=saved_path).execute()
+@traced
+def get_upload_chunk(batch_no, chunk_order):
+    return UploadChunkInfo.get_or_none((UploadChunkInfo.batch_no == batch_no)
+                                       & (UploadChunkInfo.chunk_order == chunk_order))
 
 
+@traced
 def get_white_list():
     return WhiteList.select().where(WhiteList.enabled == '1')
 
 
-def query_plugins_for_update_xml():
-    # t_a = WhiteList.alias()
-    t_b = PluginsBaseInfo.alias()
-    t_c = PluginsVersionInfo.alias()
-    t_d = SupportVersion.alias()
-    t_e = DownloadInfo.alias()
-    t_f = VendorInfo.alias()
-    return (WhiteList
-            .select(t_b.name, t_b.id, t_b.description, t_c.version, t_c.change_notes, t_c.since_build, t_c.until_build,
-                    t_c.rating, t_e.archive_suffix, t_d.product_code, t_d.build_version, t_f.name.alias('vendor_name'),
-                    t_f.email, t_f.url, t_f.dev_type)
-            .join(t_b, on=(WhiteList.plugin_id == t_b.id))
-            .join(t_c, on=(t_b.id == t_c.id))
-            .join(t_d, on=((t_c.id == t_d.id) & (t_c.version == t_d.version)))
-            .switch(WhiteList)
-            .join(t_e, on=(WhiteList.plugin_id == t_e.id))
-            .switch(t_c)
-            .join(t_f, on=(t_c.vendor_id == t_f.id))
-            .where((WhiteList.enabled == 1)
-                   & (t_d.version == t_e.version)
-                   )
-            .order_by(t_d.product_code, t_d.build_version.desc()))
+@traced
+@read_replica
+def query_plugins_for_update_xml(product_code: str = None):
+    query = (CatalogEntry
+             .select(*CATALOG_ENTRY_FIELDS)
+             .order_by(CatalogEntry.product_code, CatalogEntry.build_version.desc()))
+    if product_code:
+        query = query.where(CatalogEntry.product_code == product_code)
+    return query
 
 
+@traced
+@read_replica
 def get_recent_released_plugins(day_offset: int = 0):
     t_b = PluginsVersionInfo.alias()
     t_c = DownloadInfo.alias()
@@ -234,9 +404,7 @@ def get_recent_released_plugins(day_offset: int = 0):
             .select(t_b.id, t_b.version, t_b.since_build, t_b.archive_size, t_b.release_time, t_c.archive_suffix,
                     t_d.dev_type)
             .join(t_b, on=((WhiteList.plugin_id == t_b.id)
-                           & (t_b.update_time >= fn.DATE_ADD(fn.CURDATE(),
-                                                             NodeList((SQL('INTERVAL'), day_offset, SQL('DAY'))))
-                              )
+                           & (t_b.update_time >= days_from_today(day_offset))
                            ))
             .join(t_c, on=((t_b.id == t_c.id) & (t_b.version == t_c.version)))
             .switch(t_b)
@@ -244,6 +412,7 @@ def get_recent_released_plugins(day_offset: int = 0):
             .where(WhiteList.enabled == 1))
 
 
+@traced
 def query_plugins_without_suffix():
     sub_q = (SupportVersion
              .select(SupportVersion.id, SupportVersion.version)
@@ -258,6 +427,7 @@ def query_plugins_without_suffix():
             )
 
 
+@traced
 def update_plugin_file_suffix(plugin_id: str, version: str, suffix: str):
     (DownloadInfo
      .update(archive_suffix=suffix)
@@ -265,29 +435,201 @@ def update_plugin_file_suffix(plugin_id: str, version: str, suffix: str):
      .execute())
 
 
+@traced
+def save_plugin_file_suffixes(suffix_list: list, batch_size: int = 500):
+    """
+    批量写入插件包后缀名，download_info已有记录时只更新archive_suffix
+    :param suffix_list: [(plugin_id, version, archive_name, archive_suffix), ...]
+    :param batch_size: 每条insert语句的行数
+    """
+    with db.atomic():
+        for batch in chunked(suffix_list, batch_size):
+            (DownloadInfo
+             .insert_many(batch, fields=[DownloadInfo.id, DownloadInfo.version,
+                                         DownloadInfo.archive_name, DownloadInfo.archive_suffix])
+             .on_conflict(conflict_target=conflict_target(DownloadInfo.id, DownloadInfo.version),
+                          preserve=[DownloadInfo.archive_suffix])
+             .execute())
+        refresh_catalog_entries(plugin_ids=[row[0] for row in suffix_list])
+
+
+@traced
+@read_replica
 def get_latest_plugins_by_ide(product_code: str, build_version: str):
+    return (CatalogEntry
+            .select(*CATALOG_ENTRY_FIELDS)
+            .where((CatalogEntry.product_code == product_code)
+                   & (CatalogEntry.build_version == build_version)))
+
+
+@traced
+@read_replica
+def get_plugin_index_rows(plugin_ids: list = None):
+    """
+    插件搜索索引的数据：白名单中可下载的插件版本及其开发者
+    :param plugin_ids: 只查询这些插件，为空时查询全部
+    """
+    t_b = PluginsBaseInfo.alias()
+    t_c = PluginsVersionInfo.alias()
+    t_e = VendorInfo.alias()
+    t_f = DownloadInfo.alias()
+    query = (WhiteList
+             .select(t_b.id, t_b.name, t_c.version, t_c.since_build, t_c.until_build, t_c.rating, t_c.archive_size,
+                     t_c.release_time, t_c.tags, t_e.name.alias('vendor_name'), t_f.archive_suffix)
+             .join(t_b, on=(WhiteList.plugin_id == t_b.id))
+             .join(t_c, on=(t_b.id == t_c.id))
+             .join(t_f, on=((t_c.id == t_f.id) & (t_c.version == t_f.version)))
+             .switch(t_c)
+             .join(t_e, JOIN.LEFT_OUTER, on=(t_c.vendor_id == t_e.id))
+             .where(WhiteList.enabled == 1))
+    if plugin_ids:
+        query = query.where(t_b.id.in_(plugin_ids))
+    return query
+
+
+@traced
+@read_replica
+def get_plugin_products(plugin_ids: list = None):
+    """
+    插件各版本出现在哪些产品的目录中
+    """
+    query = (CatalogEntry
+             .select(CatalogEntry.id, CatalogEntry.version, CatalogEntry.product_code)
+             .distinct())
+    if plugin_ids:
+        query = query.where(CatalogEntry.id.in_(plugin_ids))
+    return query
+
+
+@traced
+@read_replica
+def get_catalog_changes(since=None):
+    """
+    目录记录在指定时间之后重新写入的插件，catalog_entry按范围删除后重新写入，create_time即最近变化的时间
+    :return: 查询结果(id, changed_at)
+    """
+    query = (CatalogEntry
+             .select(CatalogEntry.id, fn.MAX(CatalogEntry.create_time).alias('changed_at'))
+             .group_by(CatalogEntry.id))
+    if since is not None:
+        query = query.where(CatalogEntry.create_time >= since)
+    return query
+
+
+@traced
+@read_replica
+def get_white_list_changes(since=None):
+    query = WhiteList.select(WhiteList.plugin_id, WhiteList.update_time.alias('changed_at'))
+    if since is not None:
+        query = query.where(WhiteList.update_time >= since)
+    return query
+
+
+CATALOG_ENTRY_FIELDS = [CatalogEntry.product_code, CatalogEntry.build_version, CatalogEntry.id, CatalogEntry.version,
+                        CatalogEntry.name, CatalogEntry.description, CatalogEntry.change_notes,
+                        CatalogEntry.since_build, CatalogEntry.until_build, CatalogEntry.rating,
+                        CatalogEntry.archive_suffix, CatalogEntry.vendor_name, CatalogEntry.email, CatalogEntry.url,
+                        CatalogEntry.dev_type]
+
+
+def catalog_entry_source(ide_info: list = None, plugin_ids: list = None, product_code: str = None):
+    """
+    catalog_entry表对应的关联查询：白名单插件在各IDE版本下的最新版本，字段顺序与CATALOG_ENTRY_FIELDS一致
+    :param ide_info: 只查询这些IDE版本，[(product_code, build_version), ...]
+    :param plugin_ids: 只查询这些插件
+    :param product_code: 只查询该产品
+    """
     t_b = PluginsBaseInfo.alias()
     t_c = PluginsVersionInfo.alias()
     t_d = SupportVersion.alias()
     t_e = VendorInfo.alias()
     t_f = DownloadInfo.alias()
-    return (WhiteList
-            .select(t_b.name, t_b.id, t_b.description, t_c.version, t_c.change_notes, t_c.since_build, t_c.until_build,
-                    t_c.rating, t_e.name.alias('vendor_name'), t_e.email, t_e.url, t_e.dev_type, t_f.archive_suffix)
-            .join(t_b, on=(WhiteList.plugin_id == t_b.id))
-            .join(t_c, on=(t_b.id == t_c.id))
-            .join(t_d, on=((t_c.id == t_d.id) & (t_c.version == t_d.version)))
-            .switch(t_c)
-            .join(t_e, on=(t_c.vendor_id == t_e.id))
-            .switch(t_d)
-            .join(t_f, on=((t_d.id == t_f.id) & (t_d.version == t_f.version)))
-            .where((WhiteList.enabled == 1)
-                   & (t_d.product_code == product_code)
-                   & (t_d.build_version == build_version)
-                   & (t_d.latest_version == 1))
-            )
+    query = (WhiteList
+             .select(t_d.product_code, t_d.build_version, t_b.id, t_c.version, t_b.name, t_b.description,
+                     t_c.change_notes, t_c.since_build, t_c.until_build, t_c.rating, t_f.archive_suffix,
+                     t_e.name.alias('vendor_name'), t_e.email, t_e.url, t_e.dev_type)
+             .join(t_b, on=(WhiteList.plugin_id == t_b.id))
+             .join(t_c, on=(t_b.id == t_c.id))
+             .join(t_d, on=((t_c.id == t_d.id) & (t_c.version == t_d.version)))
+             .switch(t_c)
+             .join(t_e, on=(t_c.vendor_id == t_e.id))
+             .switch(t_d)
+             .join(t_f, on=((t_d.id == t_f.id) & (t_d.version == t_f.version)))
+             .where((WhiteList.enabled == 1) & (t_d.latest_version == 1)))
+    if ide_info:
+        query = query.where(Tuple(t_d.product_code, t_d.build_version).in_(ide_info))
+    if plugin_ids:
+        query = query.where(t_d.id.in_(plugin_ids))
+    if product_code:
+        query = query.where(t_d.product_code == product_code)
+    return query
+
+
+@traced
+def refresh_catalog_entries(ide_info: list = None, plugin_ids: list = None, batch_size: int = 500):
+    """
+    按IDE版本或插件重新计算catalog_entry：删除范围内的记录后从关联查询整体写入，都不指定时重建全表。
+    同一事务中增加受影响IDE版本的catalog_generation，目录缓存和ETag随之更新
+    :param ide_info: 数据有变化的IDE版本，[(product_code, build_version), ...]
+    :param plugin_ids: 数据有变化的插件(版本、下载信息、白名单、开发者等)
+    :param batch_size: 每个事务处理的IDE版本或插件数
+    :return: 写入的记录数
+    """
+    if ide_info:
+        scopes = [{'ide_info': batch} for batch in chunked(ide_info, batch_size)]
+    elif plugin_ids:
+        scopes = [{'plugin_ids': batch} for batch in chunked(sorted(set(plugin_ids)), batch_size)]
+    elif ide_info is None and plugin_ids is None:
+        scopes = [{}]
+    else:
+        return 0
+    rebuild_all = scopes == [{}]
+
+    row_count = 0
+    changed_ide_info = set()
+    for scope in scopes:
+        delete_query = CatalogEntry.delete()
+        if scope.get('ide_info'):
+            delete_query = delete_query.where(Tuple(CatalogEntry.product_code,
+                                                    CatalogEntry.build_version).in_(scope['ide_info']))
+        if scope.get('plugin_ids'):
+            delete_query = delete_query.where(CatalogEntry.id.in_(scope['plugin_ids']))
+        with db.atomic():
+            # 插件的记录删除前后所在的IDE版本都受影响(如停用插件、不再支持某些版本)
+            scope_ide_info = set(scope['ide_info']) if scope.get('ide_info') else set()
+            if scope.get('plugin_ids'):
+                scope_ide_info.update(_catalog_ide_info(scope['plugin_ids']))
+            delete_query.execute()
+            row_count += CatalogEntry.insert_from(catalog_entry_source(**scope), CATALOG_ENTRY_FIELDS).execute() or 0
+            if scope.get('plugin_ids'):
+                scope_ide_info.update(_catalog_ide_info(scope['plugin_ids']))
+            touch_ide_versions(None if rebuild_all else scope_ide_info)
+        changed_ide_info.update(scope_ide_info)
+
+    for listener in catalog_change_listeners:
+        listener(None if rebuild_all else sorted(changed_ide_info))
+    return row_count
+
+
+def _catalog_ide_info(plugin_ids: list):
+    return (CatalogEntry
+            .select(CatalogEntry.product_code, CatalogEntry.build_version)
+            .where(CatalogEntry.id.in_(plugin_ids))
+            .distinct()
+            .tuples())
+
+
+@traced
+def set_white_list(plugin_id: str, enabled: str):
+    (WhiteList
+     .insert(plugin_id=plugin_id, enabled=enabled)
+     .on_conflict(conflict_target=conflict_target(WhiteList.plugin_id),
+                  update={WhiteList.enabled: enabled, WhiteList.update_time: datetime.datetime.now()})
+     .execute())
+    refresh_catalog_entries(plugin_ids=[plugin_id])
 
 
+@traced
 def get_old_support_version(plugin_id: str, plugin_version: str, ide_info: list):
     return (SupportVersion
             .select()
@@ -300,33 +642,147 @@ def get_old_support_version(plugin_id: str, plugin_version: str, ide_info: list)
                    ))
 
 
+@traced
 def update_sync_status(product_code: str, build_version: str, status: str):
     (IdeVersion
-     .update(last_sync_status=status, last_sync_time=datetime.datetime.now())
+     .update(last_sync_status=status, last_sync_time=datetime.datetime.now(),
+             catalog_generation=IdeVersion.catalog_generation + 1)
      .where((IdeVersion.product_code == product_code) & (IdeVersion.build_version == build_version))
      .execute())
 
 
-def update_ide_versions(product_code: str, build_version: str, version: str):
-    (IdeVersion
-     .insert(product_code=product_code, build_version=build_version, version=version)
-     .on_conflict_ignore()
-     .execute())
-
-
-def check_internal_plugin_support_ide_version():
-    t_b = PluginsVersionInfo.alias()
-    t_c = VendorInfo.alias()
-    t_d = IdeVersion.alias()
-    return (WhiteList
-            .select(t_d.product_code, t_d.build_version, t_d.version, t_b.id, t_b.version.alias('plugin_version'))
-            .join(t_b, on=(WhiteList.plugin_id == t_b.id))
-            .join(t_c, on=((t_b.vendor_id == t_c.id) & (t_c.dev_type == 'internal')))
-            .switch(t_b)
-            .join(t_d, on=((fn.version_compare(t_d.build_version, t_b.since_build) <= 0)
-                           & ((fn.ISNULL(t_b.until_build))
-                              | (fn.version_compare(t_d.build_version, t_b.until_build) >= 0))
-                           & (t_d.create_time >= fn.DATE_ADD(fn.CURDATE(),
-                                                             NodeList((SQL('INTERVAL'), -5, SQL('DAY')))))))
-            .where(WhiteList.enabled == '1')
-            .order_by(t_b.id, t_d.build_version.desc(), t_b.create_time.desc()))
+@traced
+def add_ide_versions(ide_list: list, batch_size: int = 500):
+    """
+    批量新增IDE版本，已存在的忽略
+    :param ide_list: [(product_code, build_version, version), ...]
+    :param batch_size: 每条insert语句的行数
+    """
+    with db.atomic():
+        for batch in chunked(ide_list, batch_size):
+            (IdeVersion
+             .insert_many(batch, fields=[IdeVersion.product_code, IdeVersion.build_version, IdeVersion.version])
+             .on_conflict_ignore()
+             .execute())
+
+
+@traced
+def get_internal_plugin_versions():
+    """
+    白名单中内部开发的插件的全部版本，同一插件按创建时间从新到旧排列
+    """
+    return (PluginsVersionInfo
+            .select(PluginsVersionInfo.id, PluginsVersionInfo.version, PluginsVersionInfo.since_build,
+                    PluginsVersionInfo.until_build)
+            .join(WhiteList, on=((PluginsVersionInfo.id == WhiteList.plugin_id) & (WhiteList.enabled == '1')))
+            .join(VendorInfo, on=((PluginsVersionInfo.vendor_id == VendorInfo.id) & (VendorInfo.dev_type == 'internal')))
+            .order_by(PluginsVersionInfo.id, PluginsVersionInfo.create_time.desc()))
+
+
+@traced
+def get_expired_rows(model, before: datetime.datetime, batch_size: int):
+    """
+    按创建时间取一批过期记录
+    :param model: 带create_time字段的模型
+    :param before: 早于该时间创建的记录视为过期
+    :param batch_size: 每批记录数
+    """
+    return (model
+            .select()
+            .where(model.create_time < before)
+            .order_by(model.create_time)
+            .limit(batch_size))
+
+
+@traced
+def count_expired_rows(model, before: datetime.datetime):
+    return model.select().where(model.create_time < before).count()
+
+
+@traced
+def delete_rows_by_key(model, rows: list):
+    """
+    按主键删除记录，每次只锁定给定的行
+    :return: 删除的记录数
+    """
+    key_fields = model._meta.get_primary_keys()
+    keys = [tuple(getattr(row, field.name) for field in key_fields) for row in rows]
+    if not keys:
+        return 0
+    if len(key_fields) == 1:
+        condition = key_fields[0].in_([key[0] for key in keys])
+    else:
+        condition = Tuple(*key_fields).in_(keys)
+    return model.delete().where(condition).execute()
+
+
+@traced
+def enqueue_job(job_type: str, payload: str, pending_key: str = None):
+    """
+    新增后台任务，指定合并键且已有相同合并键的待执行任务时不再新增
+    :return: (任务id, 是否合并到已有任务)
+    """
+    for _ in range(3):
+        if pending_key:
+            pending_job = BackgroundJob.get_or_none(BackgroundJob.pending_key == pending_key)
+            if pending_job:
+                return pending_job.id, True
+        try:
+            with db.atomic():
+                return BackgroundJob.insert(job_type=job_type, payload=payload, pending_key=pending_key).execute(), False
+        except IntegrityError:
+            # 并发新增了相同合并键的任务，重新查询
+            continue
+    raise RuntimeError('failed to enqueue job {}'.format(pending_key))
+
+
+def _runnable_job_condition(now: datetime.datetime):
+    # 到达执行时间的待执行任务，或执行者租约已过期(进程退出)的执行中任务
+    return (((BackgroundJob.status == 'pending')
+             & (BackgroundJob.run_after.is_null() | (BackgroundJob.run_after <= now)))
+            | ((BackgroundJob.status == 'running') & (BackgroundJob.lease_until < now)))
+
+
+@traced
+def claim_job(lease_seconds: int, candidates: int = 5):
+    """
+    领取一个可执行的任务，按id条件更新保证同一任务只会被一个执行者领取
+    :param lease_seconds: 租约秒数，执行者需在租约到期前更新进度
+    :return: BackgroundJob，没有可执行的任务时返回None
+    """
+    now = datetime.datetime.now()
+    # 先读完候选任务再逐个更新，SQLite中未结束的读事务升级为写事务时会直接返回database is locked
+    job_ids = [job.id for job in BackgroundJob.select(BackgroundJob.id).where(_runnable_job_condition(now))
+               .order_by(BackgroundJob.id).limit(candidates)]
+    for job_id in job_ids:
+        claimed = (BackgroundJob
+                   .update(status='running', pending_key=None, attempts=BackgroundJob.attempts + 1,
+                           lease_until=now + datetime.timedelta(seconds=lease_seconds), update_time=now)
+                   .where((BackgroundJob.id == job_id) & _runnable_job_condition(now))
+                   .execute())
+        if claimed:
+            return BackgroundJob.get_by_id(job_id)
+    return None
+
+
+@traced
+def update_job(job_id: int, **fields):
+    fields['update_time'] = datetime.datetime.now()
+    BackgroundJob.update(**fields).where(BackgroundJob.id == job_id).execute()
+
+
+@traced
+def renew_job_lease(job_id: int, lease_seconds: int):
+    """
+    延长执行中任务的租约，任务已结束或已被重新领取为pending时不更新
+    """
+    now = datetime.datetime.now()
+    return (BackgroundJob
+            .update(lease_until=now + datetime.timedelta(seconds=lease_seconds), update_time=now)
+            .where((BackgroundJob.id == job_id) & (BackgroundJob.status == 'running'))
+            .execute())
+
+
+@traced
+def get_job(job_id: int):
+    return BackgroundJob.get_or_none(BackgroundJob.id == job_id)
@@ -0,0 +1,17 @@
+-- get_latest_plugins_by_ide / get_download_info_by_ide：按IDE版本取最新插件版本，包含id、version以覆盖关联字段
+CREATE INDEX idx_support_version_ide ON support_version(product_code, build_version, latest_version, id, version);
+
+-- get_recent_released_plugins：按更新时间取近期发布的插件
+CREATE INDEX idx_plugins_version_info_update_time ON plugins_version_info(update_time);
+
+-- 按开发者查询插件版本
+CREATE INDEX idx_plugins_version_info_vendor_id ON plugins_version_info(vendor_id);
+
+-- check_internal_plugin_support_ide_version：近期新增的IDE版本
+CREATE INDEX idx_ide_version_create_time ON ide_version(create_time);
+
+-- get_vendor_info_by_name / check_vendor_info
+CREATE INDEX idx_vendor_info_name ON vendor_info(name);
+
+-- get_valid_tmp_ticket：按access_token取最近创建的票据
+CREATE INDEX idx_tmp_ticket_access_token ON tmp_ticket(access_token, create_time);
@@ -0,0 +1,41 @@
+-- 生成updatePlugins.xml所需字段的冗余表，由写入路径增量维护，可用 python db_migrate.py catalog-verify 校验
+CREATE TABLE catalog_entry(
+    product_code VARCHAR(4) NOT NULL,
+    build_version VARCHAR(32) NOT NULL,
+    id VARCHAR(96) NOT NULL,
+    version VARCHAR(64) NOT NULL,
+    name VARCHAR(128) NOT NULL,
+    description TEXT,
+    change_notes TEXT,
+    since_build VARCHAR(32),
+    until_build VARCHAR(32),
+    rating VARCHAR(5),
+    archive_suffix VARCHAR(10),
+    vendor_name VARCHAR(128),
+    email VARCHAR(256),
+    url VARCHAR(256),
+    dev_type VARCHAR(10),
+    create_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    update_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY(product_code, build_version, id, version)
+);
+
+-- 按插件增量维护时删除该插件的记录
+CREATE INDEX idx_catalog_entry_plugin ON catalog_entry(id, version);
+
+-- 首次创建时从现有数据全量生成，与server_dao.catalog_entry_source()一致
+INSERT INTO catalog_entry(product_code, build_version, id, version, name, description, change_notes, since_build,
+                          until_build, rating, archive_suffix, vendor_name, email, url, dev_type)
+SELECT d.product_code, d.build_version, b.id, c.version, b.name, b.description, c.change_notes, c.since_build,
+       c.until_build, c.rating, f.archive_suffix, e.name, e.email, e.url, e.dev_type
+  FROM white_list a
+  JOIN plugins_base_info b ON a.plugin_id = b.id
+  JOIN plugins_version_info c ON b.id = c.id
+  JOIN support_version d ON c.id = d.id AND c.version = d.version
+  JOIN vendor_info e ON c.vendor_id = e.id
+  JOIN download_info f ON d.id = f.id AND d.version = f.version
+ WHERE a.enabled = '1'
+   AND d.latest_version = 1
+   AND NOT EXISTS (SELECT 1 FROM catalog_entry g
+                    WHERE g.product_code = d.product_code AND g.build_version = d.build_version
+                      AND g.id = d.id AND g.version = d.version);
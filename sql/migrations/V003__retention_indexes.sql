@@ -0,0 +1,8 @@
+-- maintenance.py按创建时间分批查找过期记录
+CREATE INDEX idx_support_version_history_create_time ON support_version_history(create_time);
+
+CREATE INDEX idx_tmp_ticket_create_time ON tmp_ticket(create_time);
+
+CREATE INDEX idx_upload_batch_info_create_time ON upload_batch_info(create_time);
+
+CREATE INDEX idx_upload_chunk_info_create_time ON upload_chunk_info(create_time);
@@ -0,0 +1,4 @@
+-- 分片上传时记录每个分片的md5，合并时由分片md5合成整个文件的校验值，不需要重新读取文件
+ALTER TABLE upload_chunk_info ADD COLUMN checksum VARCHAR(32);
+
+ALTER TABLE upload_batch_info ADD COLUMN checksum VARCHAR(40);
@@ -0,0 +1,21 @@
+-- 上传后的Nexus发布和目录重新生成在后台任务中执行
+CREATE TABLE background_job(
+    id BIGINT NOT NULL AUTO_INCREMENT,
+    job_type VARCHAR(32) NOT NULL,
+    payload TEXT,
+    status VARCHAR(10) NOT NULL DEFAULT 'pending',
+    pending_key VARCHAR(255),
+    attempts INT NOT NULL DEFAULT 0,
+    progress INT NOT NULL DEFAULT 0,
+    total INT NOT NULL DEFAULT 0,
+    message TEXT,
+    result TEXT,
+    run_after DATETIME,
+    lease_until DATETIME,
+    create_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    update_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY(id),
+    UNIQUE KEY backgroundjob_pending_key(pending_key)
+);
+
+CREATE INDEX idx_background_job_status ON background_job(status, run_after);
@@ -0,0 +1,6 @@
+-- 分片上传声明分片数和文件大小，支持乱序、并行和断点续传
+ALTER TABLE upload_batch_info ADD COLUMN chunk_count INT;
+
+ALTER TABLE upload_batch_info ADD COLUMN archive_size BIGINT;
+
+ALTER TABLE upload_batch_info ADD COLUMN user_name VARCHAR(255);
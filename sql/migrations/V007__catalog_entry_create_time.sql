@@ -0,0 +1,2 @@
+-- 插件搜索索引按create_time查找目录有变化的插件
+CREATE INDEX idx_catalog_entry_create_time ON catalog_entry(create_time);
@@ -0,0 +1,2 @@
+-- 目录缓存按递增的版本号区分，代替只精确到秒的last_sync_time/update_time
+ALTER TABLE ide_version ADD COLUMN catalog_generation BIGINT NOT NULL DEFAULT 0;